@@ -0,0 +1,180 @@
+'''collects where the time (and optionally memory) goes during a conversion'''
+import sys
+import time
+try:
+    import resource
+except ImportError:
+    #not available on windows, peak rss just isn't reported there
+    resource = None
+
+#the order phases are reported in, each followed by its sub-phases (emit.cpp
+#for each language's backend under emit), anything else goes after them
+PHASES = ["grammar load", "cache lookup", "read", "prefilter", "parse", "emit", "write", "cache store"]
+
+def _peak_rss():
+    '''peak resident memory of this process in bytes, None if unknown'''
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    #macOS reports bytes, everything else kilobytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class _Phase:
+    '''times one run of a phase, pausing whatever phase it interrupts so
+    each phase's time only counts its own work'''
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+        self.start = None
+        #the highest peak of any phase run inside this one
+        self.child_peak = 0
+
+    def __enter__(self):
+        if self.stats.trace_memory:
+            import tracemalloc
+            tracemalloc.reset_peak()
+        now = time.perf_counter()
+        if self.stats.running:
+            parent = self.stats.running[-1]
+            self.stats.add_time(parent.name, now - parent.start)
+        self.stats.running.append(self)
+        self.start = now
+        return self
+
+    def __exit__(self, *_):
+        now = time.perf_counter()
+        self.stats.running.pop()
+        self.stats.add_time(self.name, now - self.start)
+        if self.stats.trace_memory:
+            import tracemalloc
+            peak = max(tracemalloc.get_traced_memory()[1], self.child_peak)
+            self.stats.add_peak(self.name, peak)
+            if self.stats.running:
+                self.stats.running[-1].child_peak = max(self.stats.running[-1].child_peak, peak)
+        if self.stats.running:
+            self.stats.running[-1].start = now
+        return False
+
+class ConversionStats:
+    '''wall time per phase, struct/field/byte counts and throughput for one
+    or more conversions. With trace_memory the peak python allocation during
+    each phase is recorded too, which slows everything down noticeably'''
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.created = time.perf_counter()
+        self.times = {}
+        self.peaks = {}
+        self.counts = {"files": 0, "structs": 0, "fields": 0, "bytes_in": 0, "bytes_out": 0,
+                       "cache_hits": 0}
+        self.languages = {}
+        self.running = []
+        if trace_memory:
+            #only imported when it's used, it costs a few ms at startup otherwise
+            import tracemalloc
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+
+    def phase(self, name):
+        '''a context manager timing everything inside it as name'''
+        return _Phase(self, name)
+
+    def add_time(self, name, seconds):
+        '''adds seconds to a phase'''
+        self.times[name] = self.times.get(name, 0.0) + seconds
+
+    def add_peak(self, name, peak):
+        '''raises a phase's peak memory to peak if it's higher'''
+        self.peaks[name] = max(self.peaks.get(name, 0), peak)
+
+    def count(self, **counts):
+        '''adds to the named counters'''
+        for name, value in counts.items():
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def add_output(self, language, seconds, size):
+        '''records writing one output file'''
+        entry = self.languages.setdefault(language, {"seconds": 0.0, "bytes": 0})
+        entry["seconds"] += seconds
+        entry["bytes"] += size
+        self.count(bytes_out=size)
+
+    def merge(self, other):
+        '''folds the as_dict() of another run (e.g. from a worker) into these stats'''
+        for name, phase in other["phases"].items():
+            self.add_time(name, phase["seconds"])
+            if "peak_bytes" in phase:
+                self.add_peak(name, phase["peak_bytes"])
+        for name, value in other["counts"].items():
+            self.count(**{name: value})
+        for language, entry in other["languages"].items():
+            mine = self.languages.setdefault(language, {"seconds": 0.0, "bytes": 0})
+            mine["seconds"] += entry["seconds"]
+            mine["bytes"] += entry["bytes"]
+
+    def as_dict(self):
+        '''everything collected so far as plain json-able data'''
+        wall = time.perf_counter() - self.created
+        ordered = []
+        for phase in PHASES:
+            ordered += sorted(name for name in self.times
+                              if name == phase or name.startswith(phase + "."))
+        ordered += sorted(name for name in self.times if name not in ordered)
+        phases = {}
+        for name in ordered:
+            phases[name] = {"seconds": self.times[name]}
+            if name in self.peaks:
+                phases[name]["peak_bytes"] = self.peaks[name]
+        return {
+            "wall_seconds": wall,
+            "peak_rss_bytes": _peak_rss(),
+            "phases": phases,
+            "languages": self.languages,
+            "counts": dict(self.counts),
+            "structs_per_second": self.counts["structs"] / wall if wall else 0.0,
+            "bytes_per_second": self.counts["bytes_in"] / wall if wall else 0.0,
+        }
+
+    def report(self):
+        '''a human readable summary'''
+        stats = self.as_dict()
+        lines = ["{:<14}{:>11}".format("phase", "ms")]
+        for name, phase in stats["phases"].items():
+            line = "{:<14}{:>11.2f}".format(name, phase["seconds"] * 1000)
+            if "peak_bytes" in phase:
+                line += "  peak {:.1f}MB".format(phase["peak_bytes"] / 1e6)
+            lines.append(line)
+        for language, entry in sorted(stats["languages"].items()):
+            lines.append("{:<14}{:>11.2f}  {} bytes".format("  " + language, entry["seconds"] * 1000,
+                                                           entry["bytes"]))
+        lines.append("{:<14}{:>11.2f}".format("total", stats["wall_seconds"] * 1000))
+        counts = stats["counts"]
+        lines.append("{files} file(s), {structs} structs, {fields} fields, {bytes_in} bytes in, "
+                     "{bytes_out} bytes out, {cache_hits} cache hit(s)".format(**counts))
+        lines.append("{:.0f} structs/s, {:.2f} MB/s".format(stats["structs_per_second"],
+                                                          stats["bytes_per_second"] / 1e6))
+        if stats["peak_rss_bytes"] is not None:
+            lines.append("peak rss {:.1f}MB".format(stats["peak_rss_bytes"] / 1e6))
+        return "\n".join(lines)
+
+class NoStats:
+    '''stands in for ConversionStats when nobody is collecting'''
+    class _NoPhase:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            return False
+
+    _NO_PHASE = _NoPhase()
+
+    def phase(self, _):
+        '''times nothing'''
+        return self._NO_PHASE
+
+    def count(self, **_):
+        '''counts nothing'''
+        pass
+
+    def add_output(self, *_):
+        '''records nothing'''
+        pass
@@ -1,11 +1,132 @@
+'''builds lark parsers from rgrammar.g, caching the compiled LALR tables'''
+import hashlib
+import importlib
+import logging
+import os
+import pickle
+import tempfile
+import re
+import lark
 from lark import Lark
+from lark.exceptions import UnexpectedCharacters
+from lark.grammar import Rule
+from lark.lexer import TerminalDef
+from output_cache import DEFAULT_CACHE_DIR
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+GRAMMAR_PATH = os.path.join(HERE, "rgrammar.g")
+#name of the optional pre-generated parser module, see write_parser_module
+PARSER_MODULE = "rgrammar_parser"
+#classes lark needs to rebuild a serialized parser
+NAMESPACE = {'Rule': Rule, 'TerminalDef': TerminalDef}
+#how deep the grammar's block comment terminals can nest, see _NESTED_COMMENT
+COMMENT_DEPTH = 4
+_COMMENT_EVENTS = re.compile(r"/\*|\*/")
+
+def grammar_key(grammar):
+    '''the cache key for a grammar: its content hash plus the lark version'''
+    digest = hashlib.sha256(grammar.encode("utf-8")).hexdigest()
+    return "{}-lark{}".format(digest[:32], lark.__version__)
+
+def comment_depth(text, pos):
+    '''how deep the block comment starting at pos nests, counting itself'''
+    depth = deepest = 0
+    for match in _COMMENT_EVENTS.finditer(text, pos):
+        depth += 1 if match.group() == "/*" else -1
+        deepest = max(deepest, depth)
+        if depth == 0:
+            break
+    return deepest
 
 class TreeBuilder:
     '''builds a tree using a grammar'''
-    def __init__(self):
-        with open("rgrammar.g", 'r') as grammarfile:
-            self.parser = Lark(grammarfile.read(), parser="lalr")
-            #self.parser = Lark(grammarfile.read())
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, transformer=None):
+        '''loads the parser from the pre-generated module or the on-disk cache if
+        either matches the current grammar, otherwise compiles it from scratch.
+        A cache_dir of None disables the on-disk cache. If a transformer is given
+        its callbacks run as each rule is reduced and no tree is ever built'''
+        self.transformer = transformer
+        with open(GRAMMAR_PATH, 'r') as grammarfile:
+            self.grammar = grammarfile.read()
+        self.key = grammar_key(self.grammar)
+        self.parser = self._load_module()
+        if self.parser is None and cache_dir is not None:
+            self.parser = self._load_cache(cache_dir)
+        if self.parser is None:
+            logging.debug("compiling parser from %s", GRAMMAR_PATH)
+            self.parser = Lark(self.grammar, parser="lalr", transformer=transformer)
+            if cache_dir is not None:
+                self._save_cache(cache_dir)
+
+    def _load_module(self):
+        '''loads the parser from a shipped rgrammar_parser module, if there is
+        one and it was generated from this grammar'''
+        try:
+            module = importlib.import_module(PARSER_MODULE)
+        except ImportError:
+            return None
+        if getattr(module, "GRAMMAR_KEY", None) != self.key:
+            logging.debug("%s is stale, ignoring it", PARSER_MODULE)
+            return None
+        logging.debug("loading parser from %s", PARSER_MODULE)
+        return Lark.deserialize(module.DATA, NAMESPACE, module.MEMO, transformer=self.transformer)
+
+    def _cache_path(self, cache_dir):
+        return os.path.join(cache_dir, "{}.pickle".format(self.key))
+
+    def _load_cache(self, cache_dir):
+        '''loads the parser from the on-disk cache, returns None on a miss'''
+        try:
+            with open(self._cache_path(cache_dir), 'rb') as cachefile:
+                data, memo = pickle.load(cachefile)
+        except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+            return None
+        logging.debug("loading parser from cache %s", cache_dir)
+        return Lark.deserialize(data, NAMESPACE, memo, transformer=self.transformer)
+
+    def _serialize(self):
+        '''serializes the parser tables, leaving the transformer out'''
+        data, memo = self.parser.memo_serialize([TerminalDef, Rule])
+        data = dict(data, options=dict(data['options'], transformer=None))
+        return data, memo
+
+    def _save_cache(self, cache_dir):
+        '''writes the compiled parser to the cache, failing quietly since the
+        cache is only an optimization'''
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            #write to a temp file and rename so concurrent runs never see half a cache
+            handle, temppath = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+            with os.fdopen(handle, 'wb') as cachefile:
+                pickle.dump(self._serialize(), cachefile)
+            os.replace(temppath, self._cache_path(cache_dir))
+        except OSError as err:
+            logging.debug("couldn't write parser cache: %s", err)
+
+    def write_parser_module(self, path=os.path.join(HERE, PARSER_MODULE + ".py")):
+        '''writes a python module holding the compiled parser tables so it can be
+        shipped alongside the converter and loaded without any grammar analysis'''
+        data, memo = self._serialize()
+        with open(path, 'w') as module:
+            module.write("'''pre-generated parser tables for rgrammar.g, "
+                         "built by TreeBuilder.py. Do not edit'''\n")
+            module.write("GRAMMAR_KEY = {!r}\n".format(self.key))
+            module.write("DATA = {!r}\n".format(data))
+            module.write("MEMO = {!r}\n".format(memo))
+
+    def parse(self, filetext):
+        '''parses filetext, returning the transformer's result if there is one
+        and the lark tree otherwise. A block comment nested too deep for the
+        grammar is called out in the error'''
+        try:
+            return self.parser.parse(filetext)
+        except UnexpectedCharacters as err:
+            pos = err.pos_in_stream
+            if filetext.startswith("/*", pos) and comment_depth(filetext, pos) > COMMENT_DEPTH:
+                message = "{}\n\nblock comments can't be nested more than {} deep\n"
+                err.args = (message.format(err.args[0].rstrip("\n"), COMMENT_DEPTH),)
+            raise
 
-    def get_tree(self, filetext):
-        return self.parser.parse(filetext)
+if __name__ == "__main__":
+    #regenerate the shippable parser module
+    TreeBuilder(cache_dir=None).write_parser_module()
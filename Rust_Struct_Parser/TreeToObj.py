@@ -1,10 +1,16 @@
 '''holds the class that turns a lark tree into usable objects'''
 from lark import Transformer
 from lark.lexer import Token
+from struct_ir import Comment, PointerType, ArrayType, Field, Struct
 
 class TreeToObj(Transformer):
+    def __init__(self, keep_block_comments=False):
+        super().__init__()
+        self.keep_block_comments = keep_block_comments
+
     def start(self, items):
-        return list(items)
+        #uses, impls and everything else we skip come through as None
+        return [item for item in items if item is not None]
     
     def usedecl(self, _):
         #a use decl is made up of 1+ names and a type at the end
@@ -18,56 +24,54 @@ class TreeToObj(Transformer):
         return None
 
     def comment(self, item):
-        #just return the comment with an appropriate label
-        return ("comment", item[0].value)
+        #block comments are dropped unless we were asked to keep them
+        if item[0].type == "BLOCK_COMMENT":
+            if not self.keep_block_comments:
+                return None
+            #c and c# don't nest block comments, so defuse any inner ones
+            body = item[0].value[2:-2].replace("/*", "/ *").replace("*/", "* /")
+            return Comment("/*" + body + "*/")
+        return Comment(item[0].value)
+
+    def typealias(self, _):
+        #aliases and constants are resolved from the symbol index instead
+        return None
+
+    def constant(self, _):
+        return None
 
     def impl(self, _):
         #we don't care about impl's, return None
         return None
 
     def pointer(self, item):
-        #return {"pointer": is_mutable}
-        if(item[0].data == 'mutable'):
-            return ("pointer", True)
-        else:
-            return ("pointer", False)
+        #what it points at is filled in by modifiedtype
+        return PointerType(item[0].data == 'mutable')
+
+    def array(self, item):
+        #the element is either a type name or a pointer to one
+        if isinstance(item[0], PointerType):
+            return ArrayType(item[0].target, item[1].value, True)
+        return ArrayType(getattr(item[0], "value", item[0]), item[1].value)
 
-    def array(self,item):
-        '''return ('array', (type, number, is_pointer))'''
-        #we need to check if item is a tuple[0] is a tuple first
-        #if it's it's a pointer
-        if not isinstance(item[0], tuple):
-            return ("array", (item[0].value, item[1].value, False))
-        else:
-            return("array", (item[0][1], item[1].value, True))
-    
     def modifiedtype(self, item):
         #should only be called on pointers, others get simplified to rtypes
-        #returns the pointer object, decoded by 'pointer()' and the type
-        return (item[0], item[1].value)
+        item[0].target = item[1].value
+        return item[0]
 
     def decl(self, item):
         #for each decl, we need to know if it's private, its name, and its type
-        #return either an already processed tuple OR
-        #('field', name, type)
-        #make sure 0 is a tuple
-        if isinstance(item[0], tuple):
-            #if it's a public decl:
-            if item[0][0] == "public" and item[0][1]:
-                #if it's not a tuple, it's a `simple` type, return it
-                if not isinstance(item[2], tuple):
-                    return ('field', item[1].value, item[2].value)
-                #otherwise, return the preprocessed tuple
-                else:
-                    return ('field', item[1].value, item[2])
-            #otherwise it's already processed, just return it:
-            else:
-                return item[0]
+        #a comment, or a dropped block comment, is passed straight through
+        if item[0] is None or isinstance(item[0], Comment):
+            return item[0]
+        #if it's a public decl:
+        if isinstance(item[0], tuple) and item[0][0] == "public" and item[0][1]:
+            #a `simple` type is just a name token
+            if isinstance(item[2], Token):
+                return Field(item[1].value, item[2].value)
+            return Field(item[1].value, item[2])
         #if we hit a token, return none, it's not public
-        elif isinstance(item[0], Token):
-            return None
-        print("\n")
-        return item
+        return None
 
     def ispub(self, _):
         return ("public", True)
@@ -86,10 +90,8 @@ class TreeToObj(Transformer):
             #if it's reprc, but not public, return none
             if item[1][0] != "public":
                 return None
-            #now we know it's reprc and public, return ('struct', 'name', [])
-            name = item[2].value
-            fields = item[3:]
-            return ('struct', name, fields)
+            #now we know it's reprc and public, leave out the private fields
+            return Struct(item[2].value, [member for member in item[3:] if member is not None])
         else:
             #something went wrong, return none
             return None
\ No newline at end of file
@@ -0,0 +1,874 @@
+'''the language backends, each of which renders the IR for one language'''
+import os
+import posixpath
+from io import StringIO
+from struct_ir import Struct, PointerType, ArrayType, Comment, Import
+
+def _uses(struct, typemap):
+    '''the structs, or anything else not in typemap, that struct's fields use,
+    {name: whether it's held by value rather than pointed to}'''
+    used = {}
+    for field in struct.fields:
+        if isinstance(field.type, PointerType):
+            name, by_value = field.type.target, False
+        elif isinstance(field.type, ArrayType):
+            #an array holds its elements, unless they're pointers
+            name, by_value = field.type.element, not field.type.pointer
+        else:
+            name, by_value = field.type, True
+        if name not in typemap:
+            used[name] = used.get(name, False) or by_value
+    return used
+
+class OutputOptions:
+    '''what the converter asks of the backends on top of the items
+    themselves, each backend reads the options it cares about. Any keyword
+    left out takes its default from DEFAULTS'''
+    DEFAULTS = {
+        #whether c# structs use fixed buffers and raw pointers instead of marshaling
+        "blittable_cs": False,
+        #whether the python output also gets a numpy dtype for each struct
+        "numpy_dtypes": False,
+        #whether the c++ and c# outputs check each struct's layout, see struct_layout
+        "layout_asserts": False,
+        #whether the python output is a package with a module per struct, loaded lazily
+        "split_python": False,
+        #whether the c++ output is a header per struct, plus forward declarations
+        #and one including them all
+        "split_cpp": False,
+        #the Imports of the structs used from other outputs
+        "imports": (),
+    }
+    __slots__ = tuple(DEFAULTS)
+
+    def __init__(self, **options):
+        unknown = set(options) - set(self.DEFAULTS)
+        if unknown:
+            raise TypeError("unknown output options: {}".format(", ".join(sorted(unknown))))
+        for name, default in self.DEFAULTS.items():
+            setattr(self, name, options.get(name, default))
+
+    def settings(self):
+        '''the options as plain data, for cache keys'''
+        return [repr(getattr(self, name)) for name in self.__slots__]
+
+class Backend:
+    '''renders the IR for one language. A subclass sets LANGUAGE (its name on
+    the command line), FILETYPE (its key in a filetypes object) and OUTFILE
+    (its file name, formatted with the prefix), overrides what it needs and
+    is added with register_backend. Backends only ever see the IR, so any
+    number of them can render the same items independently'''
+    LANGUAGE = None
+    FILETYPE = None
+    OUTFILE = None
+    #whether the start of the file is only known once everything else has been
+    #written, in which case it comes from prefix
+    PREFIXED = False
+
+    def __init__(self, out_name, options=None):
+        '''out_name is the prefix and options the converter's OutputOptions'''
+        self.out_name = out_name
+        self.options = options if options is not None else OutputOptions()
+        #the Imports of the structs used from other outputs
+        self.imports = self.options.imports
+        #whether each struct is written to a file of its own, see split_item
+        self.split = False
+
+    def begin(self, out):
+        '''writes the start of the file'''
+        pass
+
+    def comment(self, out, comment):
+        '''writes a top level Comment'''
+        pass
+
+    def struct(self, out, struct):
+        '''writes a Struct'''
+        pass
+
+    def end(self, out):
+        '''writes the end of the file'''
+        pass
+
+    def prefix(self):
+        '''what goes in front of everything else, once it's all been written'''
+        return ""
+
+    def item(self, out, item):
+        '''writes one top level item'''
+        if isinstance(item, Struct):
+            self.struct(out, item)
+        else:
+            self.comment(out, item)
+
+    def render(self, items):
+        '''renders all of the items, returns the generated source'''
+        out = StringIO()
+        self.begin(out)
+        for item in items:
+            self.item(out, item)
+        self.end(out)
+        return self.prefix() + out.getvalue()
+
+    def split_item(self, item):
+        '''with split set, takes one top level item and returns the
+        [(file name, source)] it completes, if any'''
+        return []
+
+    def split_end(self):
+        '''with split set, returns the [(file name, source)] left to write once
+        every item has been seen, such as the file that pulls the rest together'''
+        return []
+
+    def files(self, items):
+        '''renders all of the items, returns {file name: generated source}'''
+        if not self.split:
+            return {self.OUTFILE.format(self.out_name): self.render(items)}
+        files = {}
+        for item in items:
+            files.update(self.split_item(item))
+        files.update(self.split_end())
+        return files
+
+class CSharpBackend(Backend):
+    '''c# structs, marshaled by default or blittable with blittable_cs'''
+    LANGUAGE = "csharp"
+    FILETYPE = "cs"
+    OUTFILE = "{}.cs"
+
+    TYPEMAP = {
+        #1 bit
+        'bool': 'byte',
+        #8-bits
+        # a c_char is a signed byte
+        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
+        # for why it's a signed byte, not unsigned
+        'c_char': 'sbyte',
+        'i8': 'sbyte',
+        'c_schar': 'sbyte',
+        #but a c_char that's a pointer is a string
+        'c_char_pntr': 'string',
+        'u8': 'byte',
+        'c_uchar': 'byte',
+        #16 bits
+        'u16': 'ushort',
+        'c_ushort': 'ushort',
+        'i16': 'short',
+        'c_short': 'short',
+        #32 bits
+        #ints
+        'c_void': 'IntPtr',
+        'u32': 'uint',
+        'c_uint': 'uint',
+        'i32': 'int',
+        'c_int': 'int',
+        #floats
+        'f32': 'float',
+        'c_float': 'float',
+        #64 bits
+        #ints
+        'i64': 'long',
+        'c_long': 'long',
+        'c_longlong': 'long',
+        'u64': 'ulong',
+        'c_ulong': 'ulong',
+        'c_ulonglong': 'ulong',
+        #floats
+        'c_double': 'double',
+        'f64': 'double',
+        #NOTE! i128 and other 128 bit integer/float types are still on
+        # rust nightly only, so we won't support them
+    }
+
+    #the only element types c# allows in a fixed size buffer
+    FIXEDTYPES = {'bool', 'byte', 'char', 'short', 'int', 'long', 'sbyte', 'ushort', 'uint',
+                  'ulong', 'float', 'double'}
+
+    HEADERS = ["using System;", "using System.Linq;",
+               "using System.Runtime.InteropServices;\n\n",
+               "namespace {}\n{{"]
+
+    def __init__(self, out_name, options=None):
+        super().__init__(out_name, options)
+        self.blittable_cs = self.options.blittable_cs
+        self.layout_asserts = self.options.layout_asserts
+
+    @staticmethod
+    def get_map(key, ispointer=False):
+        '''gets from c-sharp type map'''
+        if key in CSharpBackend.TYPEMAP:
+            #handle if it's a c_char pointer
+            if ispointer and key == "c_char":
+                key = key + "_pntr"
+            return CSharpBackend.TYPEMAP[key]
+        return key
+
+    def begin(self, out):
+        headers = CSharpBackend.HEADERS
+        if self.imports:
+            #the other outputs' namespaces go with the rest of the usings
+            usings = ["using {};".format(imported.prefix) for imported in self.imports]
+            headers = (headers[:2] + [headers[2].rstrip("\n")] + usings[:-1] + [usings[-1] + "\n\n"]
+                       + headers[3:])
+        for line in headers:
+            out.write(line.format(self.out_name) + "\n")
+
+    def comment(self, out, comment):
+        out.write("\t" + comment.text + "\n")
+
+    def struct(self, out, struct):
+        if self.layout_asserts and struct.layout is not None:
+            out.write("\t[StructLayout(LayoutKind.Sequential, Size = {})]\n".format(struct.layout.size))
+        else:
+            out.write("\t[StructLayout(LayoutKind.Sequential)]\n")
+        if self.blittable_cs:
+            out.write("\tpublic unsafe struct {}\n\t{{\n".format(struct.name))
+        else:
+            out.write("\tpublic struct {}\n\t{{\n".format(struct.name))
+        for member in struct.members:
+            if isinstance(member, Comment):
+                out.write("\t\t" + member.text + "\n")
+            elif isinstance(member.type, PointerType):
+                if self.blittable_cs:
+                    self._write_blittable_pointer(out, member.name, member.type.target)
+                else:
+                    self._write_pointer(out, member.name, member.type.target)
+            elif isinstance(member.type, ArrayType):
+                if self.blittable_cs:
+                    self._write_blittable_array(out, member.name, member.type)
+                else:
+                    self._write_array(out, member.name, member.type)
+            else:
+                out.write("\t\tpublic {} {};\n".format(self.get_map(member.type), member.name))
+        out.write("\t}\n\n")
+
+    def end(self, out):
+        out.write("}")
+
+    def _write_pointer(self, out, name, pointee):
+        #a c_char pointer is a string, anything else is just an address
+        if pointee == 'c_char':
+            out.write("\t\t[MarshalAs(UnmanagedType.LPStr)]\n")
+            out.write("\t\tpublic string {};\n".format(name))
+        else:
+            out.write("\t\tpublic IntPtr {};\n".format(name))
+
+    def _write_array(self, out, name, array):
+        if not array.pointer:
+            cstype = self.get_map(array.element)
+            out.write("\t\t[MarshalAs(UnmanagedType.ByValArray, SizeConst = {})]\n"
+                      .format(array.length))
+        elif array.element == 'c_char':
+            cstype = "string"
+            out.write("\t\t[MarshalAs(UnmanagedType.ByValArray, ArraySubType = UnmanagedType.LPStr, "
+                      "SizeConst = {})]\n".format(array.length))
+        else:
+            cstype = "IntPtr"
+            out.write("\t\t[MarshalAs(UnmanagedType.ByValArray, SizeConst = {})]\n"
+                      .format(array.length))
+        out.write("\t\tpublic {0}[] {1};\n".format(cstype, name))
+
+    def _write_blittable_pointer(self, out, name, pointee):
+        '''writes a pointer field as a raw pointer, strings as byte* with a
+        span over their bytes, and anything that isn't a primitive as IntPtr'''
+        if pointee == 'c_char':
+            out.write("\t\tpublic byte* {};\n".format(name))
+            out.write("\t\tpublic ReadOnlySpan<byte> {0}_bytes => "
+                      "MemoryMarshal.CreateReadOnlySpanFromNullTerminated({0});\n".format(name))
+        elif self.get_map(pointee) in CSharpBackend.FIXEDTYPES:
+            out.write("\t\tpublic {}* {};\n".format(self.get_map(pointee), name))
+        else:
+            out.write("\t\tpublic IntPtr {};\n".format(name))
+
+    def _write_blittable_array(self, out, name, array):
+        '''writes an array inline in the struct, as a fixed buffer when c#
+        allows one and as numbered fields otherwise, with a span over it. The
+        span points straight at the struct, so it must be pinned or on the stack'''
+        cstype = "IntPtr" if array.pointer else self.get_map(array.element)
+        if cstype in CSharpBackend.FIXEDTYPES:
+            out.write("\t\tpublic fixed {} {}[{}];\n".format(cstype, name, array.length))
+            first = name
+        else:
+            for index in range(int(array.length)):
+                out.write("\t\tpublic {} {}_{};\n".format(cstype, name, index))
+            first = "&{}_0".format(name)
+        out.write("\t\tpublic Span<{0}> {1}_span {{ get {{ fixed ({0}* p = {2}) "
+                  "{{ return new Span<{0}>(p, {3}); }} }} }}\n".format(cstype, name, first, array.length))
+
+class CppBackend(Backend):
+    '''c++ typedef'd structs, with layout static_asserts if asked for'''
+    LANGUAGE = "cpp"
+    FILETYPE = "cpp"
+    OUTFILE = "{}.h"
+
+    TYPEMAP = {
+        'bool': 'bool',
+        #8-bits
+        # a c_char is a signed byte
+        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
+        # for why it's a signed byte, not unsigned
+        'c_char': 'signed char',
+        'c_char_pntr': 'char*',
+        'i8': 'signed char',
+        'c_schar': 'signed char',
+        'u8': 'unsigned char',
+        'c_uchar': 'unsigned char',
+        #16 bits
+        'u16': 'unsigned short',
+        'c_ushort': 'unsigned short',
+        'i16': 'short',
+        'c_short': 'short',
+        #32 bits
+        #ints
+        'c_void': 'void*',
+        'u32': 'unsigned int',
+        'c_uint': 'unsigned int',
+        'i32': 'int',
+        'c_int': 'int',
+        #floats
+        'f32': 'float',
+        'c_float': 'float',
+        #64 bits
+        #ints
+        'i64': 'long long int',
+        'c_long': 'long long int',
+        'c_longlong': 'long long int',
+        'u64': 'unsigned long long int',
+        'c_ulong': 'unsigned long long int',
+        'c_ulonglong': 'unsigned long long int',
+        #floats
+        'c_double': 'double',
+        'f64': 'double',
+        #NOTE! i128 and other 128 bit integer/float types are still on
+        # rust nightly only, so we won't support them
+    }
+
+    HEADERS = ['#include <stdbool.h>', '#include <cstdint>\n',
+               '#ifndef {0}_H', '#define {0}_H\n']
+    #with split_cpp, the header forward declaring every struct, formatted with the prefix
+    FWDFILE = "{}_fwd.h"
+
+    def __init__(self, out_name, options=None):
+        super().__init__(out_name, options)
+        self.layout_asserts = self.options.layout_asserts
+        self.split = self.options.split_cpp
+        #when split, the comments waiting for the next struct and the structs so far
+        self.pending = []
+        self.headers = []
+
+    @staticmethod
+    def get_map(key):
+        '''gets from cpp type map'''
+        if key in CppBackend.TYPEMAP:
+            return CppBackend.TYPEMAP[key]
+        return key
+
+    def begin(self, out):
+        for line in CppBackend.HEADERS:
+            out.write(line.format(self.out_name) + "\n")
+        if self.layout_asserts:
+            #for offsetof
+            out.write("#include <cstddef>\n\n")
+        if self.imports:
+            for imported in self.imports:
+                out.write('#include "{}"\n'.format(
+                    posixpath.join(imported.path, CppBackend.OUTFILE.format(imported.prefix))))
+            out.write("\n")
+
+    def comment(self, out, comment):
+        out.write(comment.text + "\n")
+
+    def struct(self, out, struct):
+        out.write("typedef struct {}Tag {{\n".format(struct.name))
+        for member in struct.members:
+            if isinstance(member, Comment):
+                out.write("\t" + member.text + "\n")
+            elif isinstance(member.type, PointerType):
+                out.write("\t{} {};\n".format(self._pointer(member.type.target), member.name))
+            elif isinstance(member.type, ArrayType):
+                element = member.type.element
+                ctype = self._pointer(element) if member.type.pointer else self.get_map(element)
+                out.write("\t{} {}[{}];\n".format(ctype, member.name, member.type.length))
+            else:
+                out.write("\t{} {};\n".format(self.get_map(member.type), member.name))
+        out.write("}} {};\n\n".format(struct.name))
+        if self.layout_asserts and struct.layout is not None:
+            self._write_layout_asserts(out, struct.layout)
+
+    def end(self, out):
+        out.write("#endif")
+
+    @staticmethod
+    def _pointer(pointee):
+        '''the type of a pointer to pointee'''
+        #a c_char pointer is a string, and c_void is already written as a pointer
+        if pointee == "c_char":
+            return CppBackend.TYPEMAP["c_char_pntr"]
+        if pointee == "c_void":
+            return CppBackend.TYPEMAP["c_void"]
+        if pointee not in CppBackend.TYPEMAP:
+            #a pointer to a struct goes by its tag, which declares it if it
+            #isn't yet, so it can point to itself or to a later struct
+            return "struct {}Tag*".format(pointee)
+        return CppBackend.TYPEMAP[pointee] + "*"
+
+    @staticmethod
+    def _write_layout_asserts(out, layout):
+        '''checks at compile time that the c++ struct is laid out like the rust one'''
+        out.write('static_assert(sizeof({0}) == {1}, "{0} should be {1} bytes");\n'
+                  .format(layout.name, layout.size))
+        for field in layout.fields:
+            out.write('static_assert(offsetof({0}, {1}) == {2}, "{0}.{1} should be at offset {2}");\n'
+                      .format(layout.name, field.name, field.offset))
+        out.write("\n")
+
+    def split_item(self, item):
+        '''writes a struct, with the comments before it, to a header of its
+        own. It includes the headers of the structs it holds and nothing else,
+        the ones it points to are declared by their tags'''
+        if not isinstance(item, Struct):
+            self.pending.append(item)
+            return []
+        #structs from other outputs are in their own split headers too
+        owners = {name: imported for imported in self.imports for name in imported.names}
+        includes = []
+        if any(field.type == "bool" or isinstance(field.type, ArrayType) and field.type.element == "bool"
+               for field in item.fields):
+            includes.append("<stdbool.h>")
+        if self.layout_asserts and item.layout is not None:
+            includes.append("<cstddef>")
+        for name, by_value in sorted(_uses(item, CppBackend.TYPEMAP).items()):
+            imported = owners.get(name)
+            if not by_value:
+                continue
+            if imported is None:
+                includes.append('"{}.h"'.format(name))
+            else:
+                header = posixpath.join("..", imported.path, imported.prefix, name + ".h")
+                includes.append('"{}"'.format(header))
+        out = StringIO()
+        out.write("#ifndef {0}_{1}_H\n#define {0}_{1}_H\n\n".format(self.out_name, item.name))
+        for include in includes:
+            out.write("#include {}\n".format(include))
+        if includes:
+            out.write("\n")
+        for comment in self.pending:
+            self.comment(out, comment)
+        self.pending = []
+        self.struct(out, item)
+        out.write("#endif\n")
+        header = os.path.join(self.out_name, item.name + ".h")
+        self.headers.append((item.name, header))
+        return [(header, out.getvalue())]
+
+    def split_end(self):
+        '''the forward declarations header, and the umbrella header that
+        includes every struct's, with any comments after the last struct'''
+        forward = StringIO()
+        forward.write("#ifndef {0}_FWD_H\n#define {0}_FWD_H\n\n".format(self.out_name))
+        for name, _ in self.headers:
+            forward.write("typedef struct {0}Tag {0};\n".format(name))
+        forward.write("\n#endif\n")
+        umbrella = StringIO()
+        umbrella.write("#ifndef {0}_H\n#define {0}_H\n\n".format(self.out_name))
+        for _, header in self.headers:
+            umbrella.write('#include "{}"\n'.format(header.replace(os.sep, "/")))
+        umbrella.write("\n")
+        for comment in self.pending:
+            self.comment(umbrella, comment)
+        self.pending = []
+        umbrella.write("#endif\n")
+        return [(CppBackend.FWDFILE.format(self.out_name), forward.getvalue()),
+                (CppBackend.OUTFILE.format(self.out_name), umbrella.getvalue())]
+
+class PythonBackend(Backend):
+    '''ctypes structures, plus numpy dtypes with numpy_dtypes'''
+    LANGUAGE = "python"
+    FILETYPE = "pyf"
+    OUTFILE = "{}.py"
+    #we import ctypes at the end so that we only import what we need
+    PREFIXED = True
+
+    TYPEMAP = {
+        'bool': 'c_bool',
+        #8-bits
+        # a c_char is a signed byte
+        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
+        # for why it's a signed byte, not unsigned
+        'c_char': 'c_byte',
+        'c_char_pntr': 'c_char_p',
+        'i8': 'c_byte',
+        'c_schar': 'c_byte',
+        'u8': 'c_ubyte',
+        'c_uchar': 'c_ubyte',
+        #16 bits
+        'u16': 'c_ushort',
+        'c_ushort': 'c_ushort',
+        'i16': 'c_short',
+        'c_short': 'c_short',
+        #32 bits
+        #ints
+        'c_void': 'c_void_p',
+        'u32': 'c_uint',
+        'c_uint': 'c_uint',
+        'i32': 'c_int',
+        'c_int': 'c_int',
+        #floats
+        'f32': 'c_float',
+        'c_float': 'c_float',
+        #64 bits
+        #ints
+        'i64': 'c_longlong',
+        'c_long': 'c_longlong',
+        'c_longlong': 'c_longlong',
+        'u64': 'c_ulonglong',
+        'c_ulong': 'c_ulonglong',
+        'c_ulonglong': 'c_ulonglong',
+        #floats
+        'c_double': 'c_double',
+        'f64': 'c_double',
+        #NOTE! i128 and other 128 bit integer/float types are still on
+        # rust nightly only, so we won't support them
+    }
+
+    #with numpy_dtypes, helpers for viewing memory as arrays of the structs
+    NUMPYHELPERS = """def view_buffer(dtype, buffer, count=-1, offset=0):
+    '''views bytes, a bytearray, an mmap or any other buffer as a record
+    array of dtype without copying it'''
+    return numpy.frombuffer(buffer, dtype, count, offset).view(numpy.recarray)
+
+def view_address(dtype, address, count):
+    '''views count records starting at a raw pointer (an int or a ctypes
+    pointer) without copying them'''
+    if not isinstance(address, int):
+        address = cast(address, c_void_p).value
+    buffer = (c_char * (dtype.itemsize * count)).from_address(address)
+    return numpy.frombuffer(buffer, dtype, count).view(numpy.recarray)
+
+def view_file(dtype, path, mode="r", offset=0, count=None):
+    '''memory maps a file of records of dtype'''
+    return numpy.memmap(path, dtype, mode, offset, count).view(numpy.recarray)
+
+"""
+    #what the helpers need from ctypes
+    NUMPYIMPORTS = ["sizeof", "c_char", "c_void_p", "cast"]
+    #with split_python, the package's __init__.py, which only imports a
+    #struct's module the first time the struct is used
+    LAZYINIT = '''from importlib import import_module
+
+#{{name: the module it's defined in}}
+_MODULES = {{
+{}    }}
+__all__ = list(_MODULES)
+
+def __getattr__(name):
+    if name not in _MODULES:
+        raise AttributeError("module {{!r}} has no attribute {{!r}}".format(__name__, name))
+    value = getattr(import_module("." + _MODULES[name], __name__), name)
+    globals()[name] = value
+    return value
+
+def __dir__():
+    return sorted(set(globals()) | set(_MODULES))
+
+'''
+    #the module the numpy helpers go in when split
+    NUMPYMODULE = "_numpy_helpers"
+
+    def __init__(self, out_name, options=None):
+        super().__init__(out_name, options)
+        self.numpy_dtypes = self.options.numpy_dtypes
+        self.split = self.options.split_python
+        #for python, we don't want to import *, so we keep a list of our
+        #ctypes imports, the only one we know we'll need right now is Structure
+        self.ctypes = ["Structure"]
+        #the structs written so far, and the ones declared ahead of their fields
+        #because something pointed to them before they were written
+        self.defined = set()
+        self.declared = set()
+        #when split, the comments waiting for the next struct and the (comments
+        #before it, struct) so far
+        self.pending = []
+        self.structs = []
+
+    @staticmethod
+    def get_map(key, used_keys):
+        '''gets from python type map'''
+        if key in PythonBackend.TYPEMAP:
+            if PythonBackend.TYPEMAP[key] not in used_keys:
+                used_keys.append(PythonBackend.TYPEMAP[key])
+            return PythonBackend.TYPEMAP[key]
+        return key
+
+    @staticmethod
+    def _block_comment(comment, indent):
+        '''turns a kept block comment into python comment lines'''
+        lines = comment[2:-2].strip().split("\n")
+        return "".join("{}#{}\n".format(indent, line.strip()) for line in lines)
+
+    def begin(self, out):
+        self.ctypes = ["Structure"]
+        self.defined = set()
+        self.declared = set()
+        if self.numpy_dtypes:
+            out.write(PythonBackend.NUMPYHELPERS)
+
+    def comment(self, out, comment):
+        if comment.text.startswith("/*"):
+            out.write(self._block_comment(comment.text, ""))
+        else:
+            out.write(comment.text.replace("//", "#") + "\n")
+
+    def struct(self, out, struct):
+        self._declare_pointees(out, struct)
+        if struct.name in self.declared:
+            #the class is there already, it just needs its fields
+            out.write("{}._fields_ = [\n".format(struct.name))
+            indent = "    "
+        else:
+            out.write("class {}(Structure):\n".format(struct.name))
+            out.write("    _fields_ = [\n")
+            indent = "        "
+        for member in struct.members:
+            if isinstance(member, Comment):
+                if member.text.startswith("/*"):
+                    out.write(self._block_comment(member.text, indent))
+                else:
+                    out.write('{}#{}\n'.format(indent, member.text.replace("//", "")))
+            elif isinstance(member.type, PointerType):
+                out.write('{}("{}", {}),\n'.format(indent, member.name, self._pointer(member.type.target)))
+            elif isinstance(member.type, ArrayType):
+                element = member.type.element
+                ctype = self._pointer(element) if member.type.pointer else self.get_map(element, self.ctypes)
+                out.write('{}("{}", {} * {}),\n'.format(indent, member.name, ctype, member.type.length))
+            else:
+                ctype = self.get_map(member.type, self.ctypes)
+                out.write('{}("{}", {}),\n'.format(indent, member.name, ctype))
+        out.write(indent + "]\n\n")
+        self.defined.add(struct.name)
+        if self.numpy_dtypes:
+            self._write_dtype(out, struct)
+
+    def _pointer(self, pointee):
+        '''the ctypes type of a pointer to pointee'''
+        #a c_char pointer is a string, and c_void is already written as a pointer
+        if pointee == "c_char":
+            return self.get_map("c_char_pntr", self.ctypes)
+        if pointee == "c_void":
+            return self.get_map(pointee, self.ctypes)
+        if "POINTER" not in self.ctypes:
+            self.ctypes.append("POINTER")
+        return "POINTER({})".format(self.get_map(pointee, self.ctypes))
+
+    def _declare_pointees(self, out, struct):
+        '''POINTER needs a class, so the structs that struct points to that
+        aren't written or imported yet, itself included, are declared first
+        with no fields. Their fields are filled in when they're written'''
+        imported = {name for imported in self.imports for name in imported.names}
+        for field in struct.fields:
+            if isinstance(field.type, PointerType):
+                pointee = field.type.target
+            elif isinstance(field.type, ArrayType) and field.type.pointer:
+                pointee = field.type.element
+            else:
+                continue
+            if (pointee in PythonBackend.TYPEMAP or pointee in self.defined or pointee in self.declared
+                    or pointee in imported):
+                continue
+            out.write("class {}(Structure):\n    pass\n\n".format(pointee))
+            self.declared.add(pointee)
+
+    def end(self, out):
+        if self.numpy_dtypes:
+            self.ctypes.extend(name for name in PythonBackend.NUMPYIMPORTS if name not in self.ctypes)
+
+    def prefix(self):
+        '''builds the ctypes import line for just the types that we used'''
+        return self._import_lines(self.imports) + "\n"
+
+    def _import_lines(self, imports, local=()):
+        '''the ctypes import line, then the imports of local, the (module, names)
+        used from this package's other modules, then of the structs used from
+        other outputs'''
+        ctype_line = "from ctypes import "
+        for ctype in self.ctypes:
+            ctype_line += "{}, ".format(ctype)
+        lines = ctype_line[0:-2] + "\n"
+        for module, names in local:
+            lines += "from .{} import {}\n".format(module, ", ".join(names))
+        for imported in imports:
+            names = list(imported.names)
+            if self.numpy_dtypes:
+                names += ["{}_dtype".format(name) for name in imported.names]
+            lines += "from {}{} import {}\n".format(imported.package + "." if imported.package else "",
+                                                   imported.prefix, ", ".join(names))
+        if self.numpy_dtypes:
+            lines += "import numpy\n"
+        return lines
+
+    def _split_file(self, module):
+        return os.path.join(self.out_name, module + ".py")
+
+    def split_item(self, item):
+        '''holds on to each struct, with the comments before it, until
+        split_end, as structs that point to each other have to share a module
+        and that isn't known until they've all been seen'''
+        if isinstance(item, Struct):
+            self.structs.append((self.pending, item))
+        else:
+            self.pending.append(item)
+            return []
+        self.pending = []
+        return []
+
+    def _groups(self):
+        '''splits the structs into the strongly connected parts of which uses
+        which, each in the order they came in. Structs only share a module when
+        they end up using each other, so the modules never import in a circle.
+        The groups come out with the ones they use before them'''
+        position = {struct.name: index for index, (_, struct) in enumerate(self.structs)}
+        uses = [sorted(position[name] for name in _uses(struct, PythonBackend.TYPEMAP) if name in position)
+                for _, struct in self.structs]
+        #tarjan's algorithm, with a stack of our own as chains of structs can be long
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        groups = []
+        for root in range(len(self.structs)):
+            if root in index:
+                continue
+            work = [(root, 0)]
+            while work:
+                node, edge = work.pop()
+                if edge == 0:
+                    index[node] = lowlink[node] = len(index)
+                    stack.append(node)
+                    on_stack.add(node)
+                if edge < len(uses[node]):
+                    work.append((node, edge + 1))
+                    used = uses[node][edge]
+                    if used not in index:
+                        work.append((used, 0))
+                    elif used in on_stack:
+                        lowlink[node] = min(lowlink[node], index[used])
+                    continue
+                if lowlink[node] == index[node]:
+                    group = []
+                    while node not in group:
+                        group.append(stack.pop())
+                        on_stack.discard(group[-1])
+                    groups.append([self.structs[member] for member in sorted(group)])
+                if work:
+                    lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+        return groups
+
+    def _group_module(self, group, modules):
+        '''writes a group of structs, with the comments before each, to a
+        module that imports just what they use from elsewhere. modules is
+        {struct name: the module it's in}'''
+        names = {struct.name for _, struct in group}
+        used = {}
+        for _, struct in group:
+            for name, by_value in _uses(struct, PythonBackend.TYPEMAP).items():
+                if name not in names:
+                    used[name] = used.get(name, False) or by_value
+        imports = []
+        for imported in self.imports:
+            imported_names = [name for name in imported.names if name in used]
+            if imported_names:
+                imports.append(Import(imported.prefix, imported.path, imported.package, imported_names))
+        other = {name for imported in imports for name in imported.names}
+        #anything else is one of this output's structs, a struct that's only
+        #pointed to and isn't anywhere is declared in this module instead
+        local = {}
+        for name, by_value in sorted(used.items()):
+            if name in other or name not in modules and not by_value:
+                continue
+            local.setdefault(modules.get(name, "_" + name), []).append(name)
+            if by_value and self.numpy_dtypes:
+                local[modules.get(name, "_" + name)].append(name + "_dtype")
+        out = StringIO()
+        self.ctypes = ["Structure"]
+        self.defined = {name for names in local.values() for name in names}
+        self.declared = set()
+        for comments, struct in group:
+            for comment in comments:
+                self.comment(out, comment)
+            self.struct(out, struct)
+        if self.numpy_dtypes and "sizeof" not in self.ctypes:
+            self.ctypes.append("sizeof")
+        return (self._split_file(modules[group[0][1].name]),
+                self._import_lines(imports, sorted(local.items())) + "\n" + out.getvalue())
+
+    def split_end(self):
+        '''a module for each group of structs, see _groups, the package's lazy
+        __init__.py, with any comments after the last struct, and the numpy
+        helpers' module'''
+        groups = self._groups()
+        #each group's module is named after its first struct
+        module_of = {struct.name: "_" + group[0][1].name for group in groups for _, struct in group}
+        files = [self._group_module(group, module_of) for group in groups]
+        modules = []
+        for _, struct in self.structs:
+            modules.append((struct.name, module_of[struct.name]))
+            if self.numpy_dtypes:
+                modules.append((struct.name + "_dtype", module_of[struct.name]))
+        if self.numpy_dtypes:
+            modules.extend((name, PythonBackend.NUMPYMODULE)
+                           for name in ("view_buffer", "view_address", "view_file"))
+            helpers = ("from ctypes import c_char, c_void_p, cast\nimport numpy\n\n"
+                       + PythonBackend.NUMPYHELPERS)
+            files.append((self._split_file(PythonBackend.NUMPYMODULE), helpers))
+        out = StringIO()
+        out.write(PythonBackend.LAZYINIT.format("".join('    "{}": "{}",\n'.format(name, module)
+                                                        for name, module in modules)))
+        for comment in self.pending:
+            self.comment(out, comment)
+        self.pending = []
+        self.structs = []
+        files.append((self._split_file("__init__"), out.getvalue()))
+        return files
+
+    @staticmethod
+    def _numpy_format(rtype):
+        '''the numpy format matching the ctypes type a rust type is written as'''
+        if rtype in PythonBackend.TYPEMAP:
+            return PythonBackend.TYPEMAP[rtype]
+        #another struct, which has its own dtype
+        return "{}_dtype".format(rtype)
+
+    def _write_dtype(self, out, struct):
+        '''writes a numpy dtype with the same fields, offsets and size as the
+        ctypes struct just written, arrays becoming subarrays'''
+        names = []
+        formats = []
+        for field in struct.fields:
+            names.append(field.name)
+            if isinstance(field.type, PointerType):
+                #a pointer is an address
+                formats.append("numpy.uintp")
+            elif isinstance(field.type, ArrayType) and field.type.pointer:
+                formats.append("(numpy.uintp, {})".format(field.type.length))
+            elif isinstance(field.type, ArrayType):
+                formats.append("({}, {})".format(self._numpy_format(field.type.element), field.type.length))
+            else:
+                formats.append(self._numpy_format(field.type))
+        out.write("{}_dtype = numpy.dtype({{\n".format(struct.name))
+        out.write('    "names": [{}],\n'.format(", ".join('"{}"'.format(name) for name in names)))
+        out.write('    "formats": [{}],\n'.format(", ".join(formats)))
+        out.write('    "offsets": [{}],\n'.format(
+            ", ".join("{}.{}.offset".format(struct.name, name) for name in names)))
+        out.write('    "itemsize": sizeof({}),\n'.format(struct.name))
+        out.write("    })\n\n")
+
+#{filetype: backend class}, in the order outputs are written
+BACKENDS = {}
+
+def register_backend(backend):
+    '''makes a Backend subclass available as a language'''
+    BACKENDS[backend.FILETYPE] = backend
+    return backend
+
+for _backend in (CppBackend, CSharpBackend, PythonBackend):
+    register_backend(_backend)
@@ -0,0 +1,162 @@
+'''converts many rust files at once across a pool of worker processes'''
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from output_cache import DEFAULT_CACHE_DIR
+from ConversionStats import ConversionStats
+from rust_struct_parser import StructConverter, language_filetypes
+from symbol_index import SymbolIndex, index_path
+
+#each worker process loads the parser the first time one of its files needs
+#parsing, and reuses it for every file after that. A batch that's all cache
+#hits never loads it
+_BUILDER = None
+#the (cache_dir, keep_block_comments) the worker's parser is loaded with
+_PARSER_SETTINGS = (DEFAULT_CACHE_DIR, False)
+
+def _expand(entry):
+    '''the files one input, a file, a directory or a glob, stands for'''
+    if os.path.isdir(entry):
+        return [os.path.join(root, name) for root, _, files in os.walk(entry)
+                for name in files if name.endswith(".rs")]
+    if os.path.isfile(entry):
+        return [entry]
+    return [path for path in glob.glob(entry, recursive=True) if os.path.isfile(path)]
+
+def find_inputs(inputs):
+    '''expands files, directories and globs into a sorted, de-duplicated
+    list of .rs files'''
+    return sorted(set(os.path.normpath(path) for entry in inputs for path in _expand(entry)))
+
+def output_plan(files, out_path):
+    '''works out where each file's outputs go: {file: (output dir, name)}.
+    The input layout is mirrored under out_path so equally named files
+    don't collide'''
+    common = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in files])
+    plan = {}
+    for in_file in files:
+        reldir = os.path.relpath(os.path.dirname(os.path.abspath(in_file)), common)
+        out_name = os.path.splitext(os.path.basename(in_file))[0]
+        plan[in_file] = (os.path.normpath(os.path.join(out_path, reldir)), out_name)
+    return plan
+
+def _init_worker(cache_dir, log_level, keep_block_comments):
+    '''sets up a worker process, whose parser is loaded when it's first needed'''
+    global _BUILDER, _PARSER_SETTINGS # pylint: disable=W0603
+    logging.basicConfig(level=log_level, format='%(message)s')
+    _BUILDER = None
+    _PARSER_SETTINGS = (cache_dir, keep_block_comments)
+
+def _converter(in_file, out_path, out_name, stats, options):
+    '''a StructConverter using the worker's parser, if it's been loaded'''
+    cache_dir, keep_block_comments = _PARSER_SETTINGS
+    return StructConverter(in_file, out_path, out_name, cache_dir=cache_dir, builder=_BUILDER,
+                           keep_block_comments=keep_block_comments, stats=stats, **options)
+
+def _keep_parser(converter):
+    '''holds on to the parser converter loaded, if it did, for the next file.
+    The grammar load is then counted in that file's stats'''
+    global _BUILDER # pylint: disable=W0603
+    if converter.builder_loaded:
+        _BUILDER = converter.builder
+
+def _job_stats(profile):
+    '''a ConversionStats for one job if stats are being collected, profile
+    being whether to trace memory, or None if they aren't'''
+    if profile is None:
+        return None
+    return ConversionStats(trace_memory=profile)
+
+def _stats_dict(stats):
+    return None if stats is None else stats.as_dict()
+
+def _convert_one(job):
+    '''converts a single file in a worker, returns (path, error or None, stats or None)'''
+    in_file, out_path, out_name, languages, stream, profile, options = job
+    stats = _job_stats(profile)
+    converter = _converter(in_file, out_path, out_name, stats, options)
+    try:
+        if stream:
+            converter.stream(language_filetypes(languages))
+        else:
+            converter.convert(language_filetypes(languages))
+    except Exception as err: # pylint: disable=W0703
+        #one bad file shouldn't take the rest of the batch down with it
+        return in_file, "{}: {}".format(type(err).__name__, err), _stats_dict(stats)
+    finally:
+        _keep_parser(converter)
+    return in_file, None, _stats_dict(stats)
+
+def _parse_one(job):
+    '''parses a single file in a worker, returns (path, items or None, error or None, stats or None)'''
+    in_file, profile, options = job
+    stats = _job_stats(profile)
+    converter = _converter(in_file, None, None, stats, options)
+    try:
+        return in_file, converter.parse(), None, _stats_dict(stats)
+    except Exception as err: # pylint: disable=W0703
+        return in_file, None, "{}: {}".format(type(err).__name__, err), _stats_dict(stats)
+    finally:
+        _keep_parser(converter)
+
+def _run(function, jobs, workers, cache_dir, keep_block_comments):
+    '''runs function over jobs, in order, either in process or on a pool'''
+    initargs = (cache_dir, logging.getLogger().getEffectiveLevel(), keep_block_comments)
+    if workers == 1:
+        _init_worker(*initargs)
+        return [function(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=initargs) as pool:
+        return list(pool.map(function, jobs))
+
+def convert_batch(inputs, out_path, languages, prefix="output", merge=False,
+                  workers=None, cache_dir=DEFAULT_CACHE_DIR, keep_block_comments=False, stream=False,
+                  stats=None, **options):
+    '''converts every .rs file found in inputs. Each file is written to
+    out_path as <name>.h/.cs/.py, mirroring the input directory layout, or with
+    merge all structs go into a single set of files named after prefix. stream
+    converts each file a struct at a time, see StructConverter.stream. Each
+    file's timings are added to stats, if given. Any other options are handed
+    to each file's StructConverter. Types, aliases and constants are looked
+    up across every input, see symbol_index.
+    returns a list of (path, error) for the files that failed, and for the
+    inputs that don't match any file'''
+    found = [(entry, _expand(entry)) for entry in inputs]
+    #a mistyped path is a failure, not an empty batch
+    failures = [(entry, "no such file, or no .rs files in it") for entry, paths in found if not paths]
+    files = sorted(set(os.path.normpath(path) for _, paths in found for path in paths))
+    if not files:
+        return failures
+    index = SymbolIndex(index_path(cache_dir, inputs))
+    index.update(files)
+    index.save()
+    workers = min(workers or os.cpu_count() or 1, len(files))
+    profile = None if stats is None else stats.trace_memory
+    if merge:
+        #a merged conversion always parses every file, only per-file outputs are cached
+        options = dict(options, output_cache_dir=None)
+        jobs = [(in_file, profile, options) for in_file in files]
+        items = []
+        results = _run(_parse_one, jobs, workers, cache_dir, keep_block_comments)
+        for in_file, parsed, error, job_stats in results:
+            if job_stats is not None:
+                stats.merge(job_stats)
+            if error is None:
+                items.extend(parsed)
+            else:
+                failures.append((in_file, error))
+        StructConverter(None, out_path, prefix, cache_dir=cache_dir, builder=_BUILDER,
+                        keep_block_comments=keep_block_comments, stats=stats, symbols=index.resolver(),
+                        **options).write(items, language_filetypes(languages))
+        return failures
+    plan = output_plan(files, out_path)
+    jobs = [(in_file, file_out_path, out_name, languages, stream, profile,
+             dict(options, symbols=index.resolver(in_file), imports=index.imports(in_file, plan, out_path)))
+            for in_file, (file_out_path, out_name) in plan.items()]
+    for in_file, error, job_stats in _run(_convert_one, jobs, workers, cache_dir, keep_block_comments):
+        if job_stats is not None:
+            stats.merge(job_stats)
+        if error is not None:
+            failures.append((in_file, error))
+    return failures
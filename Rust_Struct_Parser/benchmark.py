@@ -0,0 +1,493 @@
+'''benchmarks the converter on synthetic #[repr(C)] corpora of different
+shapes, records the results as json and compares them against a baseline'''
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import lark
+from TreeBuilder import TreeBuilder, DEFAULT_CACHE_DIR
+from TreeToObj import TreeToObj
+from rust_struct_parser import StructConverter, LANGUAGES
+from source_scanner import filter_reprc
+
+#rust types the converter knows how to map
+SIMPLE_TYPES = ["bool", "i8", "u8", "i16", "u16", "i32", "u32", "i64", "u64", "f32", "f64",
+                "c_char", "c_int", "c_uint", "c_long", "c_double"]
+POINTER_TYPES = ["*mut c_char", "*const c_char", "*mut c_void", "*const u8", "*mut i32"]
+
+#name: (structs, fields per struct, pointer ratio, array ratio, comment ratio)
+SCENARIOS = {
+    "structs_100": (100, 8, 0.1, 0.1, 0.1),
+    "structs_1k": (1000, 8, 0.1, 0.1, 0.1),
+    "structs_10k": (10000, 8, 0.1, 0.1, 0.1),
+    "fields_500": (20, 500, 0.1, 0.1, 0.1),
+    "pointer_heavy": (1000, 8, 0.7, 0.1, 0.1),
+    "array_heavy": (1000, 8, 0.1, 0.7, 0.1),
+    "comment_heavy": (1000, 8, 0.1, 0.1, 1.0),
+}
+#name: (#[repr(C)] structs, fields per struct, other items per struct), whole
+#crates that are mostly functions, impls and traits, converted with reprc_only
+MIXED_SCENARIOS = {
+    "mixed_reprc_only": (1000, 8, 15),
+}
+#name: (structs, fields per struct, pointer ratio, array ratio, comment ratio),
+#about 10MB of source parsed both into a whole lark tree that's transformed
+#afterwards and with TreeToObj applied inline, to compare their peak memory
+MEMORY_SCENARIOS = {
+    "memory_10mb": (40000, 8, 0.1, 0.1, 0.1),
+}
+#what --quick runs
+QUICK_SCENARIOS = ["structs_100", "structs_1k", "fields_500", "pointer_heavy", "array_heavy",
+                   "comment_heavy", "mixed_reprc_only"]
+ALL_SCENARIOS = list(SCENARIOS) + list(MIXED_SCENARIOS) + list(MEMORY_SCENARIOS)
+#a metric this much worse than the baseline is a regression
+THRESHOLD = 0.15
+#the converter's command line
+CONVERTER = [sys.executable,
+             os.path.join(os.path.dirname(os.path.abspath(__file__)), "rust_struct_parser.py")]
+
+def generate_source(structs, fields, pointer_ratio=0.1, array_ratio=0.1, comment_ratio=0.1, seed=0):
+    '''builds rust source holding structs #[repr(C)] structs of fields fields
+    each. The ratios are the chance of a field being a pointer or an array
+    and of a field (or struct) getting a comment. The same arguments always
+    give the same source'''
+    rand = random.Random(seed)
+    lines = ["extern crate libc;", "use libc::c_void;", "use std::os::raw::c_char;", ""]
+    for struct in range(structs):
+        if rand.random() < comment_ratio:
+            lines.append("//struct number {}".format(struct))
+        lines.append("#[repr(C)]")
+        lines.append("pub struct Struct{} {{".format(struct))
+        for field in range(fields):
+            if rand.random() < comment_ratio:
+                if rand.random() < 0.5:
+                    lines.append("    //field number {}".format(field))
+                else:
+                    lines.append("    /* field number {} */".format(field))
+            kind = rand.random()
+            if kind < pointer_ratio:
+                rtype = rand.choice(POINTER_TYPES)
+            elif kind < pointer_ratio + array_ratio:
+                element = rand.choice(SIMPLE_TYPES + ["*mut c_char"])
+                rtype = "[{};{}]".format(element, rand.randint(1, 64))
+            else:
+                rtype = rand.choice(SIMPLE_TYPES)
+            lines.append("    pub field_{}: {},".format(field, rtype))
+        lines.append("}")
+        lines.append("")
+    return "\n".join(lines)
+
+#the code around the structs in a mixed crate, formatted with a number. Their
+#strings, chars and comments hold braces and things that look like structs
+OTHER_ITEMS = [
+    """pub fn function_{0}(value: u32) -> u32 {{
+    let text = "{{ #[repr(C)] pub struct Fake{0} {{";
+    if value > {0} {{ value - text.len() as u32 }} else {{ value + {0} }}
+}}""",
+    """impl Plain{0} {{
+    /// returns the brace, {{
+    pub fn brace_{0}(&self) -> char {{ let brace = '{{'; brace }}
+}}""",
+    """pub trait Trait{0} {{
+    fn call(&self) -> Option<Vec<u8>>;
+    fn with_default(&self) -> u8 {{ /* a stray {{ */ {0} }}
+}}""",
+    """#[derive(Debug, Clone)]
+pub enum Enum{0} {{ First, Second(u32), Third {{ x: i32, y: i32 }} }}""",
+    """#[derive(Default)]
+pub struct Plain{0}<T> {{
+    inner: Vec<T>,
+}}""",
+    """const RAW_{0}: &str = r#"#[repr(C)] pub struct Raw{0} {{ "#;""",
+]
+
+def generate_mixed_source(structs, fields, others, seed=0):
+    '''builds the source of a crate where most of the text isn't #[repr(C)]
+    structs: generate_source's structs structs of fields fields each, with
+    others functions, impls, traits, enums and plain structs picked at
+    random before each. The same arguments always give the same source'''
+    rand = random.Random(seed)
+    #generate_source puts a blank line after its header and after each struct
+    header, *reprc = generate_source(structs, fields, seed=seed).split("\n\n")
+    blocks = [header]
+    for number, struct in enumerate(reprc):
+        for other in range(others):
+            blocks.append(rand.choice(OTHER_ITEMS).format(number * others + other))
+        blocks.append(struct)
+    return "\n\n".join(blocks)
+
+def _best_time(function, repeat):
+    '''the fastest of repeat runs of function, and its last result'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def run_scenario(builder, params, repeat=3, seed=0):
+    '''benchmarks parsing the generated source and emitting it for each language
+    and for all of them at once, returns the results as a dict'''
+    source = generate_source(*params, seed=seed)
+    converter = StructConverter(None, None, "bench", builder=builder)
+    seconds = {}
+    seconds["parse"], items = _best_time(lambda: converter.parse(source), repeat)
+    for language, filetype in sorted(LANGUAGES.items()):
+        seconds["emit_" + language], _ = _best_time(
+            lambda filetype=filetype: converter.render(items, {filetype: None}), repeat)
+    everything = {filetype: None for filetype in LANGUAGES.values()}
+    seconds["emit_all"], _ = _best_time(lambda: converter.render(items, everything), repeat)
+    #memory is measured on its own pass, tracing slows everything down
+    del items
+    tracemalloc.start()
+    converter.render(converter.parse(source), everything)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    structs, fields, pointer_ratio, array_ratio, comment_ratio = params
+    return {
+        "params": {"structs": structs, "fields": fields, "pointer_ratio": pointer_ratio,
+                   "array_ratio": array_ratio, "comment_ratio": comment_ratio, "seed": seed},
+        "bytes": len(source),
+        "seconds": seconds,
+        "peak_bytes": peak,
+    }
+
+def run_mixed_scenario(builder, params, repeat=3, seed=0):
+    '''benchmarks the #[repr(C)] pre-filter on a generated mixed crate, on its
+    own and followed by parsing what's left, returns the results as a dict'''
+    source = generate_mixed_source(*params, seed=seed)
+    converter = StructConverter(None, None, "bench", builder=builder, reprc_only=True)
+    seconds = {}
+    seconds["prefilter"], _ = _best_time(lambda: filter_reprc(source), repeat)
+    seconds["prefilter_parse"], _ = _best_time(lambda: converter.parse(source), repeat)
+    tracemalloc.start()
+    converter.parse(source)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    structs, fields, others = params
+    return {
+        "params": {"structs": structs, "fields": fields, "others": others, "reprc_only": True, "seed": seed},
+        "bytes": len(source),
+        "seconds": seconds,
+        "peak_bytes": peak,
+    }
+
+def run_memory_scenario(builder, params, seed=0, cache_dir=DEFAULT_CACHE_DIR):
+    '''parses the generated source with builder, which applies TreeToObj as
+    it goes, and with a builder that returns lark's tree for TreeToObj to
+    transform afterwards, returns the results as a dict. peak_bytes is the
+    inline parse's, tree_peak_bytes the other's. Each is timed once, as with
+    the traced runs it takes minutes'''
+    source = generate_source(*params, seed=seed)
+    tree_builder = TreeBuilder(cache_dir)
+    parses = {"inline": lambda: builder.parse(source),
+              "tree": lambda: TreeToObj().transform(tree_builder.parse(source))}
+    seconds = {}
+    peaks = {}
+    for mode, parse in parses.items():
+        seconds["parse_" + mode], _ = _best_time(parse, 1)
+        tracemalloc.start()
+        parse()
+        peaks[mode] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    structs, fields, pointer_ratio, array_ratio, comment_ratio = params
+    return {
+        "params": {"structs": structs, "fields": fields, "pointer_ratio": pointer_ratio,
+                   "array_ratio": array_ratio, "comment_ratio": comment_ratio, "seed": seed},
+        "bytes": len(source),
+        "seconds": seconds,
+        "peak_bytes": peaks["inline"],
+        "tree_peak_bytes": peaks["tree"],
+    }
+
+def run(scenarios, repeat=3, cache_dir=DEFAULT_CACHE_DIR):
+    '''runs the named scenarios, returns the results with some details of where they ran'''
+    start = time.perf_counter()
+    builder = TreeBuilder(cache_dir, TreeToObj())
+    load = time.perf_counter() - start
+    results = {}
+    for name in scenarios:
+        if name in MIXED_SCENARIOS:
+            results[name] = run_mixed_scenario(builder, MIXED_SCENARIOS[name], repeat)
+        elif name in MEMORY_SCENARIOS:
+            results[name] = run_memory_scenario(builder, MEMORY_SCENARIOS[name], cache_dir=cache_dir)
+        else:
+            results[name] = run_scenario(builder, SCENARIOS[name], repeat)
+        print("{:<18}{}".format(name, _summary(results[name])), file=sys.stderr)
+    return {
+        "machine": {"python": platform.python_version(), "lark": lark.__version__,
+                    "platform": platform.platform(), "cpus": os.cpu_count()},
+        "grammar_load_seconds": load,
+        "scenarios": results,
+    }
+
+def _summary(result):
+    '''one line of a scenario's results'''
+    times = "  ".join("{} {:.1f}ms".format(metric, seconds * 1000)
+                      for metric, seconds in result["seconds"].items())
+    if "tree_peak_bytes" in result:
+        return "{}  peak {:.1f}MB inline, {:.1f}MB tree".format(
+            times, result["peak_bytes"] / 1e6, result["tree_peak_bytes"] / 1e6)
+    return "{}  peak {:.1f}MB".format(times, result["peak_bytes"] / 1e6)
+
+def _metrics(result):
+    '''flattens a scenario's results into {metric: value}'''
+    metrics = {"seconds." + metric: value for metric, value in result["seconds"].items()}
+    if "peak_bytes" in result:
+        metrics["peak_bytes"] = result["peak_bytes"]
+    return metrics
+
+def compare(baseline, results, threshold=THRESHOLD):
+    '''compares results against a baseline run, returns a list of
+    (scenario, metric, baseline value, new value) that got more than
+    threshold worse. Scenarios whose parameters changed are skipped'''
+    regressions = []
+    for name, result in results["scenarios"].items():
+        old = baseline["scenarios"].get(name)
+        if old is None or old["params"] != result["params"]:
+            continue
+        old_metrics = _metrics(old)
+        for metric, value in _metrics(result).items():
+            if metric in old_metrics and value > old_metrics[metric] * (1 + threshold):
+                regressions.append((name, metric, old_metrics[metric], value))
+    return regressions
+
+def _serve(files, out_path, workers):
+    '''converts files through one --serve process, returns (seconds until it
+    answered a ping, seconds for the rest)'''
+    start = time.perf_counter()
+    server = subprocess.Popen(CONVERTER + ["--serve", "-j", str(workers), "--no_output_cache"],
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+    server.stdin.write('{"jsonrpc": "2.0", "id": "ready", "method": "ping"}\n')
+    server.stdin.flush()
+    server.stdout.readline()
+    ready = time.perf_counter()
+    #every request is sent straight away, the responses come back as they're done
+    for number, path in enumerate(files):
+        server.stdin.write(json.dumps({"jsonrpc": "2.0", "id": number, "method": "convert", "params": {
+            "path": path, "output_path": out_path, "prefix": "out{}".format(number)}}) + "\n")
+    server.stdin.flush()
+    for _ in files:
+        response = json.loads(server.stdout.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"]["message"])
+    done = time.perf_counter()
+    server.stdin.close()
+    server.wait()
+    return ready - start, done - ready
+
+def run_server(requests=50, workers=1, structs=10):
+    '''compares converting requests small generated files one process per
+    file, the way a build system calls the converter, with sending them all
+    to one --serve process. returns the results as a dict'''
+    work = tempfile.mkdtemp()
+    try:
+        files = []
+        for number in range(requests):
+            files.append(os.path.join(work, "in{}.rs".format(number)))
+            with open(files[-1], 'w') as source:
+                source.write(generate_source(structs, 8, seed=number))
+        start = time.perf_counter()
+        for number, path in enumerate(files):
+            subprocess.run(CONVERTER + [path, "-o", os.path.join(work, "cli"), "-p", "out{}".format(number),
+                                        "--no_output_cache"], stdout=subprocess.DEVNULL, check=True)
+        per_process = time.perf_counter() - start
+        startup, serving = _serve(files, os.path.join(work, "served"), workers)
+    finally:
+        shutil.rmtree(work)
+    return {
+        "requests": requests, "workers": workers, "structs_per_file": structs,
+        "per_process_seconds": per_process, "per_process_rps": requests / per_process,
+        "server_startup_seconds": startup, "server_seconds": serving,
+        "server_rps": requests / serving, "server_rps_with_startup": requests / (startup + serving),
+    }
+
+#imports the bindings in a fresh interpreter, printing how long that took
+#and how long using one struct then took
+IMPORT_TIMER = '''import time
+start = time.perf_counter()
+import bench
+imported = time.perf_counter()
+bench.Struct0
+print(imported - start, time.perf_counter() - imported)'''
+
+def _time_import(path, repeat):
+    '''the fastest (import seconds, first use seconds) of the bindings in path'''
+    #the first run writes the .pyc files, as the first import after installing would
+    subprocess.run([sys.executable, "-c", "import bench"], cwd=path, check=True)
+    best = None
+    for _ in range(repeat):
+        timed = subprocess.run([sys.executable, "-c", IMPORT_TIMER], cwd=path, check=True,
+                               stdout=subprocess.PIPE, universal_newlines=True)
+        seconds = tuple(float(value) for value in timed.stdout.split())
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+def run_import_time(structs=5000, repeat=5, cache_dir=DEFAULT_CACHE_DIR):
+    '''compares importing the python bindings for structs generated structs
+    written as one module with importing them split into a lazy package,
+    returns the results as a dict'''
+    source = generate_source(structs, 8)
+    builder = TreeBuilder(cache_dir, TreeToObj())
+    work = tempfile.mkdtemp()
+    results = {"structs": structs}
+    try:
+        for mode in ("single", "split"):
+            out_path = os.path.join(work, mode)
+            items = StructConverter(None, None, "bench", builder=builder).parse(source)
+            converter = StructConverter(None, out_path, "bench", builder=builder,
+                                        split_python=mode == "split")
+            converter.write(items, {LANGUAGES["python"]: None})
+            seconds = _time_import(out_path, repeat)
+            results[mode + "_import_seconds"], results[mode + "_first_use_seconds"] = seconds
+    finally:
+        shutil.rmtree(work)
+    return results
+
+#command lines that should start quickly because none of them need the parser,
+#{input} and {output} are filled in with a converted file and where it went
+STARTUP_CASES = {
+    "startup_help": ["--help"],
+    "startup_bad_args": ["--no_such_option"],
+    "startup_cache_hit": ["{input}", "-o", "{output}"],
+}
+
+def _time_startup(args, repeat):
+    '''runs the converter with args in a fresh interpreter, returns the fastest
+    wall time, the total import time -X importtime reports and the modules imported'''
+    wall = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(CONVERTER + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        elapsed = time.perf_counter() - start
+        wall = elapsed if wall is None else min(wall, elapsed)
+    traced = subprocess.run([sys.executable, "-X", "importtime"] + CONVERTER[1:] + args,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+    microseconds = 0
+    modules = set()
+    #import time: self [us] | cumulative | imported package
+    for line in traced.stderr.splitlines():
+        fields = line[len("import time:"):].split("|")
+        if line.startswith("import time:") and fields[0].strip().isdigit():
+            microseconds += int(fields[0])
+            modules.add(fields[2].strip())
+    return wall, microseconds / 1e6, modules
+
+def run_startup(repeat=3):
+    '''measures how long the command lines in STARTUP_CASES take to start,
+    returns the results shaped like run's so they can be compared the same
+    way. Each also records whether it imported lark, which none should'''
+    work = tempfile.mkdtemp()
+    try:
+        in_file = os.path.join(work, "startup.rs")
+        with open(in_file, 'w') as source:
+            source.write(generate_source(10, 8))
+        cache = ["--parser_cache", os.path.join(work, "cache")]
+        out_path = os.path.join(work, "out")
+        #fills the parser and output caches
+        subprocess.run(CONVERTER + [in_file, "-o", out_path] + cache, stdout=subprocess.DEVNULL, check=True)
+        results = {}
+        for name, case in STARTUP_CASES.items():
+            args = [arg.format(input=in_file, output=out_path) for arg in case] + cache
+            wall, imports, modules = _time_startup(args, repeat)
+            results[name] = {"params": {"args": case}, "seconds": {"wall": wall, "imports": imports},
+                             "imports_lark": "lark" in modules}
+            print("{:<20}{:8.1f}ms  imports {:6.1f}ms{}".format(
+                name, wall * 1000, imports * 1000, "  imports lark" if "lark" in modules else ""),
+                  file=sys.stderr)
+    finally:
+        shutil.rmtree(work)
+    return {
+        "machine": {"python": platform.python_version(), "lark": lark.__version__,
+                    "platform": platform.platform(), "cpus": os.cpu_count()},
+        "scenarios": results,
+    }
+
+def write_corpus(path, scenarios, seed=0):
+    '''writes each scenario's source to path as <scenario>.rs, for running
+    the full command line tool over'''
+    os.makedirs(path, exist_ok=True)
+    for name in scenarios:
+        with open(os.path.join(path, name + ".rs"), 'w') as corpus:
+            if name in MIXED_SCENARIOS:
+                corpus.write(generate_mixed_source(*MIXED_SCENARIOS[name], seed=seed))
+            else:
+                corpus.write(generate_source(*dict(SCENARIOS, **MEMORY_SCENARIOS)[name], seed=seed))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the converter on synthetic rust sources")# pylint: disable=C0103
+    parser.add_argument("scenarios", nargs="*",
+                        help="Scenarios to run (default: all of them): " + ", ".join(ALL_SCENARIOS))
+    parser.add_argument("-q", "--quick", action="store_true", help="Skip the largest scenarios")
+    parser.add_argument("-n", "--repeat", type=int, default=3,
+                        help="Runs per measurement, the fastest is kept")
+    parser.add_argument("-o", "--output", help="Write the results as JSON to this file")
+    parser.add_argument("-c", "--compare", metavar="BASELINE",
+                        help="Compare against the JSON results of an earlier run, exiting 1 on a regression")
+    parser.add_argument("-t", "--threshold", type=float, default=THRESHOLD,
+                        help="How much worse than the baseline counts as a regression (default: 0.15)")
+    parser.add_argument("--write_corpus", metavar="PATH",
+                        help="Just write the generated sources to PATH instead of benchmarking")
+    parser.add_argument("--server", type=int, metavar="REQUESTS",
+                        help="Instead, compare REQUESTS conversions of small files one process each against one --serve process") # pylint: disable=C0301
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Worker processes for the --serve process (default: 1)")
+    parser.add_argument("--startup", action="store_true",
+                        help="Instead, measure how fast --help, argument errors and output cache hits start, failing if they import lark") # pylint: disable=C0301
+    parser.add_argument("--import_time", type=int, metavar="STRUCTS",
+                        help="Instead, compare importing STRUCTS structs of Python bindings as one module and as a split package") # pylint: disable=C0301
+    args = parser.parse_args() # pylint: disable=C0103
+    NAMES = args.scenarios or (QUICK_SCENARIOS if args.quick else ALL_SCENARIOS)
+    for name in NAMES:
+        if name not in ALL_SCENARIOS:
+            parser.error("unknown scenario {}".format(name))
+    if args.write_corpus:
+        write_corpus(args.write_corpus, NAMES)
+        sys.exit(0)
+    if args.server:
+        SERVED = run_server(args.server, args.jobs)
+        print("one process per file  {:.1f} requests/s\n--serve               {:.1f} requests/s, "
+              "{:.1f} counting its {:.2f}s startup".format(
+                  SERVED["per_process_rps"], SERVED["server_rps"], SERVED["server_rps_with_startup"],
+                  SERVED["server_startup_seconds"]))
+        if args.output:
+            with open(args.output, 'w') as outfile:
+                json.dump(SERVED, outfile, indent=2)
+        sys.exit(0)
+    if args.import_time:
+        IMPORTED = run_import_time(args.import_time, args.repeat)
+        for mode in ("single", "split"):
+            print("{:<8}import {:8.2f}ms  first use {:6.2f}ms".format(
+                mode, IMPORTED[mode + "_import_seconds"] * 1000,
+                IMPORTED[mode + "_first_use_seconds"] * 1000))
+        if args.output:
+            with open(args.output, 'w') as outfile:
+                json.dump(IMPORTED, outfile, indent=2)
+        sys.exit(0)
+    RESULTS = run_startup(args.repeat) if args.startup else run(NAMES, args.repeat)
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(RESULTS, outfile, indent=2)
+    if args.compare:
+        with open(args.compare) as basefile:
+            REGRESSIONS = compare(json.load(basefile), RESULTS, args.threshold)
+        for scenario, metric, old_value, new_value in REGRESSIONS:
+            print("REGRESSION {} {}: {:.4g} -> {:.4g} ({:+.0%})".format(
+                scenario, metric, old_value, new_value, new_value / old_value - 1))
+        if REGRESSIONS:
+            sys.exit(1)
+        print("no regressions against {}".format(args.compare))
+    #starting up without needing the parser must never load it
+    LOADED = [name for name, result in RESULTS["scenarios"].items() if result.get("imports_lark")]
+    for name in LOADED:
+        print("REGRESSION {} imports lark".format(name))
+    if LOADED:
+        sys.exit(1)
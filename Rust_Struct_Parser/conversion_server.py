@@ -0,0 +1,238 @@
+'''serves convert requests as line-delimited JSON-RPC 2.0 over stdin/stdout or
+a unix socket, so a build system pays for loading the parser once rather than
+once per file. Requests run on a pool of worker processes, each with its own
+warm parser, and responses are written as they finish, which may be out of order'''
+import json
+import logging
+import os
+import socket
+import stat
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from TreeBuilder import TreeBuilder, DEFAULT_CACHE_DIR
+from TreeToObj import TreeToObj
+from rust_struct_parser import StructConverter, language_filetypes, LANGUAGES
+from struct_layout import TARGETS, DEFAULT_TARGET
+from symbol_index import SymbolIndex
+
+#JSON-RPC error codes
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+#a request that was fine but whose conversion failed
+CONVERSION_FAILED = -32000
+
+#the StructConverter options a request can set, and what each must be
+REQUEST_OPTIONS = {"reprc_only": bool, "blittable_cs": bool, "numpy_dtypes": bool,
+                   "layout_asserts": bool, "layout_target": str, "split_python": bool,
+                   "split_cpp": bool}
+
+#each worker process loads the parser once and reuses it for every request
+_BUILDER = None
+
+def _init_worker(cache_dir, log_level, keep_block_comments):
+    '''builds the per-process parser'''
+    global _BUILDER # pylint: disable=W0603
+    logging.basicConfig(level=log_level, format='%(message)s')
+    _BUILDER = TreeBuilder(cache_dir, TreeToObj(keep_block_comments))
+
+class RequestError(Exception):
+    '''a request that can't be run, with its JSON-RPC error code'''
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+
+def check_convert(params):
+    '''checks a convert request's params, raising a RequestError if they're
+    wrong, returns them with the defaults filled in'''
+    if not isinstance(params, dict):
+        raise RequestError(INVALID_PARAMS, "params must be an object")
+    unknown = set(params) - {"path", "source", "languages", "prefix", "output_path", "options"}
+    if unknown:
+        raise RequestError(INVALID_PARAMS, "unknown params: {}".format(", ".join(sorted(unknown))))
+    if ("path" in params) == ("source" in params):
+        raise RequestError(INVALID_PARAMS, "give exactly one of path and source")
+    for name in ("path", "source", "prefix", "output_path"):
+        if name in params and not isinstance(params[name], str):
+            raise RequestError(INVALID_PARAMS, "{} must be a string".format(name))
+    languages = params.get("languages", sorted(LANGUAGES))
+    if not isinstance(languages, list) or not all(language in LANGUAGES for language in languages):
+        raise RequestError(INVALID_PARAMS,
+                           "languages must be a list of: {}".format(", ".join(sorted(LANGUAGES))))
+    options = params.get("options", {})
+    if not isinstance(options, dict):
+        raise RequestError(INVALID_PARAMS, "options must be an object")
+    for name, value in options.items():
+        if name not in REQUEST_OPTIONS or not isinstance(value, REQUEST_OPTIONS[name]):
+            raise RequestError(INVALID_PARAMS, "bad option {}".format(name))
+    if options.get("layout_target", DEFAULT_TARGET) not in TARGETS:
+        raise RequestError(INVALID_PARAMS,
+                           "layout_target must be one of: {}".format(", ".join(sorted(TARGETS))))
+    return dict(params, languages=languages, prefix=params.get("prefix", "output"), options=options)
+
+def convert(params, defaults):
+    '''runs a checked convert request, in a worker. With an output_path the
+    outputs are written there and their paths returned as "written",
+    otherwise they're returned as "files", {file name: generated source}'''
+    path = params.get("path")
+    source = params.get("source")
+    index = SymbolIndex()
+    if source is None:
+        index.update([path])
+    else:
+        index.add_source(params["prefix"], source)
+    options = dict(defaults, **params["options"])
+    output_path = params.get("output_path")
+    if output_path is None:
+        options["output_cache_dir"] = None
+    converter = StructConverter(path, output_path, params["prefix"], builder=_BUILDER,
+                                symbols=index.resolver(path or params["prefix"]), **options)
+    filetypes = language_filetypes(params["languages"])
+    if output_path is None:
+        return {"files": converter.generate(filetypes, source)}
+    rendered = converter.convert(filetypes, source)
+    return {"written": [os.path.join(output_path, name) for name in sorted(rendered)]}
+
+def _convert_job(request_id, params, defaults):
+    '''runs a convert request, returns its response. Failures are turned into
+    error responses here since lark's exceptions can't be sent back from a worker'''
+    try:
+        return {"jsonrpc": "2.0", "id": request_id, "result": convert(params, defaults)}
+    except Exception as err: # pylint: disable=W0703
+        return _error(request_id, CONVERSION_FAILED, "{}: {}".format(type(err).__name__, err))
+
+def _error(request_id, code, message):
+    return {"jsonrpc": "2.0", "id": request_id, "error": {"code": code, "message": message}}
+
+class Server:
+    '''answers JSON-RPC requests on one or more connections, sharing one pool.
+    The methods are convert (see check_convert and convert), ping and
+    shutdown, which stops reading once the requests in flight are answered'''
+    def __init__(self, workers=None, cache_dir=DEFAULT_CACHE_DIR, keep_block_comments=False, **options):
+        '''options are the StructConverter options every request starts from'''
+        self.options = options
+        initargs = (cache_dir, logging.getLogger().getEffectiveLevel(), keep_block_comments)
+        self.workers = workers or os.cpu_count() or 1
+        if self.workers == 1:
+            #no pool, requests run one at a time on this process's parser
+            _init_worker(*initargs)
+            self.pool = None
+        else:
+            self.pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker,
+                                            initargs=initargs)
+        self.stopping = threading.Event()
+
+    def close(self):
+        '''waits for the requests in flight, then stops the workers'''
+        if self.pool is not None:
+            self.pool.shutdown()
+
+    def handle(self, line, respond):
+        '''handles one line of input, calling respond exactly once with its
+        response, or None for a notification, possibly later and from another thread'''
+        try:
+            request = json.loads(line)
+        except ValueError as err:
+            respond(_error(None, PARSE_ERROR, "invalid JSON: {}".format(err)))
+            return
+        if not isinstance(request, dict) or request.get("jsonrpc") != "2.0" \
+                or not isinstance(request.get("method"), str):
+            respond(_error(None, INVALID_REQUEST, "not a JSON-RPC 2.0 request"))
+            return
+        #a request without an id is a notification and gets no response
+        request_id = request.get("id")
+        answer = respond if "id" in request else lambda _: respond(None)
+        method = request["method"]
+        if method == "ping":
+            answer({"jsonrpc": "2.0", "id": request_id, "result": "pong"})
+        elif method == "shutdown":
+            self.stopping.set()
+            answer({"jsonrpc": "2.0", "id": request_id, "result": None})
+        elif method == "convert":
+            try:
+                params = check_convert(request.get("params", {}))
+            except RequestError as err:
+                answer(_error(request_id, err.code, str(err)))
+                return
+            if self.pool is None:
+                answer(_convert_job(request_id, params, self.options))
+                return
+            try:
+                future = self.pool.submit(_convert_job, request_id, params, self.options)
+            except Exception as err: # pylint: disable=W0703
+                #a worker died and took the pool with it
+                answer(_error(request_id, CONVERSION_FAILED, "{}: {}".format(type(err).__name__, err)))
+                return
+            future.add_done_callback(lambda done: answer(self._result(request_id, done)))
+        else:
+            answer(_error(request_id, METHOD_NOT_FOUND, "unknown method {}".format(method)))
+
+    @staticmethod
+    def _result(request_id, future):
+        '''the response for a finished request'''
+        err = future.exception()
+        if err is not None:
+            #the worker itself failed
+            return _error(request_id, CONVERSION_FAILED, "{}: {}".format(type(err).__name__, err))
+        return future.result()
+
+    def serve(self, infile, outfile):
+        '''answers requests read a line at a time from infile until it ends
+        or shutdown is called, writing responses to outfile. Returns once
+        every request read has been answered'''
+        lock = threading.Condition()
+        in_flight = [0]
+
+        def respond(response):
+            with lock:
+                if response is not None:
+                    outfile.write(json.dumps(response) + "\n")
+                    outfile.flush()
+                in_flight[0] -= 1
+                lock.notify()
+
+        for line in infile:
+            if not line.strip():
+                continue
+            with lock:
+                in_flight[0] += 1
+            self.handle(line, respond)
+            if self.stopping.is_set():
+                break
+        with lock:
+            lock.wait_for(lambda: in_flight[0] == 0)
+
+    def serve_socket(self, path):
+        '''answers requests on a unix socket at path, a connection at a time
+        per thread, until one of them calls shutdown. A socket left at path by
+        an earlier server is replaced, anything else there is an error'''
+        try:
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError("{} already exists and isn't a socket".format(path))
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        #wake up now and then to notice a shutdown
+        listener.settimeout(0.2)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                threading.Thread(target=self._serve_connection, args=(connection,), daemon=True).start()
+        finally:
+            listener.close()
+            os.remove(path)
+
+    def _serve_connection(self, connection):
+        connection.settimeout(None)
+        with connection, connection.makefile('r') as infile, connection.makefile('w') as outfile:
+            try:
+                self.serve(infile, outfile)
+            except OSError as err:
+                logging.debug("connection closed: %s", err)
@@ -0,0 +1,236 @@
+'''keeps one warm parser around and regenerates outputs whenever their inputs change'''
+import ctypes
+import ctypes.util
+import glob
+import logging
+import os
+import select
+import threading
+import time
+from TreeBuilder import TreeBuilder, DEFAULT_CACHE_DIR
+from TreeToObj import TreeToObj
+from rust_struct_parser import StructConverter, language_filetypes
+from batch_converter import find_inputs, output_plan
+from symbol_index import SymbolIndex, index_path
+
+def _snapshot(inputs):
+    '''maps every .rs file in inputs to its (mtime, size)'''
+    snapshot = {}
+    for path in find_inputs(inputs):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            #deleted between being listed and being looked at
+            continue
+        snapshot[path] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+def _restat(snapshot):
+    '''the (mtime, size) of just the files in snapshot, leaving out any that
+    were deleted, without looking for new ones'''
+    latest = {}
+    for path in snapshot:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        latest[path] = (stat.st_mtime_ns, stat.st_size)
+    return latest
+
+def _settle(inputs, snapshot, interval, debounce):
+    '''waits until nothing has changed for debounce seconds, so a burst of
+    writes (an editor's save, a git checkout) only triggers one rebuild'''
+    quiet_since = time.monotonic()
+    while time.monotonic() - quiet_since < debounce:
+        time.sleep(min(interval, debounce))
+        latest = _snapshot(inputs)
+        if latest != snapshot:
+            snapshot, quiet_since = latest, time.monotonic()
+    return snapshot
+
+def _directories(inputs, files):
+    '''the directories a change to inputs would show up in: the ones holding
+    files, every directory under an input directory, and for a glob or a
+    missing file the closest directory that exists'''
+    directories = {os.path.dirname(os.path.abspath(path)) for path in files}
+    for entry in inputs:
+        if os.path.isdir(entry):
+            directories.update(os.path.abspath(root) for root, _, _ in os.walk(entry))
+            continue
+        #the part of a glob before its first wildcard
+        parent = os.path.abspath(entry)
+        while glob.has_magic(parent) or not os.path.isdir(parent):
+            parent = os.path.dirname(parent)
+        directories.add(parent)
+    return directories
+
+class Inotify:
+    '''directories watched with linux's inotify, through ctypes so there's
+    nothing to install. Any event just means it's time to look again'''
+    #IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE
+    MASK = 0x002 | 0x004 | 0x008 | 0x040 | 0x080 | 0x100 | 0x200
+
+    def __init__(self):
+        '''raises OSError if inotify isn't there, as on anything but linux'''
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        if not hasattr(self.libc, "inotify_init1"):
+            raise OSError("inotify isn't available")
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watched = set()
+
+    def watch(self, directories):
+        '''adds the directories that aren't watched yet'''
+        for directory in sorted(set(directories) - self.watched):
+            if self.libc.inotify_add_watch(self.fd, os.fsencode(directory), Inotify.MASK) >= 0:
+                self.watched.add(directory)
+
+    def wait(self, timeout=None):
+        '''waits up to timeout seconds, forever if it's None, for an event and
+        reads every event that's waiting. returns whether there were any'''
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return False
+        try:
+            while os.read(self.fd, 1 << 16):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+#how often polling, when inotify isn't available, looks for new files rather
+#than just statting the ones it knows about
+RESCAN_INTERVAL = 1.0
+
+class Watcher:
+    '''regenerates the outputs for a set of inputs, reusing one parser'''
+    def __init__(self, inputs, out_path, languages, prefix="output", merge=False,
+                 cache_dir=DEFAULT_CACHE_DIR, keep_block_comments=False, stream=False, **options):
+        self.inputs = inputs
+        self.out_path = out_path
+        self.filetypes = language_filetypes(languages)
+        self.prefix = prefix
+        self.merge = merge
+        self.stream = stream
+        self.options = options
+        self.builder = TreeBuilder(cache_dir, TreeToObj(keep_block_comments))
+        self.index = SymbolIndex(index_path(cache_dir, inputs))
+        #the last snapshot of the inputs, and in merge mode each file's parsed items
+        self.known = {}
+        self.parsed = {}
+        #what each file was last converted with from the index, a file whose
+        #aliases, constants or imports change is regenerated even if it didn't
+        self.symbols = {}
+        #set to make watch return
+        self.stopping = threading.Event()
+
+    def _plan(self, files):
+        '''where each file's outputs go, a single file keeps the prefix as its name'''
+        if len(files) == 1 and len(self.inputs) == 1 and os.path.isfile(self.inputs[0]):
+            return {files[0]: (self.out_path, self.prefix)}
+        return output_plan(files, self.out_path)
+
+    def _convert(self, in_file, file_out_path, out_name, symbols):
+        converter = StructConverter(in_file, file_out_path, out_name, builder=self.builder,
+                                    symbols=symbols[0], imports=symbols[1], **self.options)
+        if self.stream:
+            converter.stream(dict(self.filetypes))
+        else:
+            converter.convert(dict(self.filetypes))
+
+    def _write_merged(self, changed):
+        '''reparses just the changed files and rewrites the merged outputs'''
+        for in_file in changed:
+            converter = StructConverter(in_file, None, None, builder=self.builder,
+                                        **dict(self.options, output_cache_dir=None))
+            try:
+                self.parsed[in_file] = converter.parse()
+            except Exception as err: # pylint: disable=W0703
+                #keep its last good structs until the next save fixes it
+                logging.error("failed to convert %s: %s", in_file, err)
+        items = []
+        for in_file in sorted(self.parsed):
+            items.extend(self.parsed[in_file])
+        StructConverter(None, self.out_path, self.prefix, builder=self.builder, symbols=self.index.resolver(),
+                        **dict(self.options, output_cache_dir=None)).write(items, dict(self.filetypes))
+
+    def update(self, snapshot):
+        '''regenerates whatever changed between the last snapshot and this one,
+        returns the files that were converted'''
+        changed = sorted(path for path, stamp in snapshot.items() if self.known.get(path) != stamp)
+        for path in self.known:
+            if path not in snapshot:
+                if self.merge:
+                    logging.warning("%s was removed, dropping its structs", path)
+                    self.parsed.pop(path, None)
+                else:
+                    logging.warning("%s was removed, its outputs are left in place", path)
+        self.known = snapshot
+        start = time.perf_counter()
+        self.index.update(sorted(snapshot))
+        self.index.save()
+        if self.merge:
+            self._write_merged(changed)
+        else:
+            plan = self._plan(sorted(snapshot))
+            symbols = {}
+            for in_file in sorted(snapshot):
+                resolver = self.index.resolver(in_file)
+                imports = self.index.imports(in_file, plan, self.out_path)
+                symbols[in_file] = (resolver, imports)
+                last = self.symbols.get(in_file)
+                if in_file not in changed and (last is None or last[0].settings() != resolver.settings()
+                                               or repr(last[1]) != repr(imports)):
+                    changed.append(in_file)
+            self.symbols = symbols
+            if not changed:
+                return changed
+            for in_file in changed:
+                try:
+                    self._convert(in_file, *plan[in_file], symbols[in_file])
+                except Exception as err: # pylint: disable=W0703
+                    #keep watching, the next save will probably fix it
+                    logging.error("failed to convert %s: %s", in_file, err)
+        logging.info("regenerated %d file(s) in %.1fms", len(changed), (time.perf_counter() - start) * 1000)
+        return changed
+
+    def watch(self, interval=0.05, debounce=0.002):
+        '''regenerates outputs as the inputs change until stopping is set. With
+        inotify it sleeps until something happens, otherwise it stats the known
+        files every interval seconds and looks for new ones every RESCAN_INTERVAL'''
+        self.update(_snapshot(self.inputs))
+        try:
+            notifier = Inotify()
+        except OSError as err:
+            logging.debug("polling for changes: %s", err)
+            self._poll(interval, debounce)
+            return
+        try:
+            while not self.stopping.is_set():
+                notifier.watch(_directories(self.inputs, self.known))
+                #wake up now and then to notice stopping
+                if not notifier.wait(0.2):
+                    continue
+                #the burst of writes is over once there's been none for debounce
+                while notifier.wait(debounce):
+                    pass
+                snapshot = _snapshot(self.inputs)
+                if snapshot != self.known:
+                    self.update(snapshot)
+        finally:
+            notifier.close()
+
+    def _poll(self, interval, debounce):
+        '''watch, without inotify'''
+        scanned = time.monotonic()
+        while not self.stopping.is_set():
+            time.sleep(interval)
+            if time.monotonic() - scanned >= RESCAN_INTERVAL:
+                snapshot, scanned = _snapshot(self.inputs), time.monotonic()
+            else:
+                snapshot = _restat(self.known)
+            if snapshot != self.known:
+                self.update(_settle(self.inputs, snapshot, interval, debounce))
@@ -0,0 +1,151 @@
+'''remembers what each input converted to so unchanged inputs skip the parser,
+and only touches output files whose contents actually change'''
+import filecmp
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+#where the compiled parser, the symbol index and the outputs are cached. It's
+#here rather than in TreeBuilder so finding it doesn't import lark
+DEFAULT_CACHE_DIR = os.environ.get("RUST_STRUCT_PARSER_CACHE",
+                                   os.path.join(os.path.expanduser("~"), ".cache", "rust_struct_parser"))
+#everything that decides what the generated code looks like
+TOOL_FILES = ["rgrammar.g", "TreeToObj.py", "rust_struct_parser.py", "source_scanner.py", "struct_ir.py",
+              "backends.py", "struct_layout.py", "symbol_index.py"]
+BLOCK_SIZE = 1 << 16
+#how many cached outputs each input keeps, the most recently used ones. More
+#than one so switching between a few languages or options still hits
+ENTRIES_PER_INPUT = 4
+
+def _tool_digest():
+    '''hashes the grammar and the converter sources, so editing the tool
+    invalidates everything it generated before'''
+    digest = hashlib.sha256()
+    for name in TOOL_FILES:
+        with open(os.path.join(HERE, name), 'rb') as toolfile:
+            digest.update(toolfile.read())
+    return digest.hexdigest()
+
+def cache_key(in_file, source, settings):
+    '''the key for converting in_file (or source, if given) with settings,
+    a list of everything else that changes the output. Every key for the same
+    in_file starts with the same directory, see store'''
+    path = os.path.abspath(in_file) if in_file is not None else ""
+    group = hashlib.sha256(path.encode("utf-8")).hexdigest()[:16]
+    digest = hashlib.sha256(_tool_digest().encode("utf-8"))
+    digest.update(repr(settings).encode("utf-8"))
+    if source is not None:
+        digest.update(source.encode("utf-8"))
+    else:
+        with open(in_file, 'rb') as infile:
+            for block in iter(lambda: infile.read(BLOCK_SIZE), b""):
+                digest.update(block)
+    return os.path.join(group, digest.hexdigest())
+
+def _entry_path(cache_dir, key):
+    return os.path.join(cache_dir, "outputs", key)
+
+def lookup(cache_dir, key):
+    '''returns the directory holding the cached outputs for key, or None on a miss'''
+    entry = _entry_path(cache_dir, key)
+    if not os.path.isdir(entry):
+        return None
+    try:
+        #marks it as recently used, so pruning keeps it
+        os.utime(entry)
+    except OSError:
+        pass
+    return entry
+
+def entry_files(entry):
+    '''the names of the files in a cache entry, relative to it'''
+    names = []
+    for root, _, files in os.walk(entry):
+        names.extend(os.path.relpath(os.path.join(root, name), entry) for name in files)
+    return sorted(names)
+
+def _prune(group):
+    '''removes all but the ENTRIES_PER_INPUT most recently used entries in
+    group, the directory of one input's entries'''
+    entries = [os.path.join(group, name) for name in os.listdir(group) if not name.endswith(".tmp")]
+    entries.sort(key=os.path.getmtime, reverse=True)
+    for entry in entries[ENTRIES_PER_INPUT:]:
+        shutil.rmtree(entry, ignore_errors=True)
+
+def store(cache_dir, key, files):
+    '''caches the output files, a dict of {file name: path}, and prunes the
+    input's older entries so editing a file again and again, as in watch mode,
+    doesn't grow the cache. Fails quietly since the cache is only an optimization'''
+    entry = _entry_path(cache_dir, key)
+    try:
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        #fill a temp dir and rename it so a half written entry is never seen
+        tempdir = tempfile.mkdtemp(dir=os.path.dirname(entry), suffix=".tmp")
+        for name, path in files.items():
+            #split outputs are in a directory of their own
+            os.makedirs(os.path.dirname(os.path.join(tempdir, name)), exist_ok=True)
+            shutil.copyfile(path, os.path.join(tempdir, name))
+        try:
+            os.rename(tempdir, entry)
+        except OSError:
+            #someone else cached the same thing first
+            shutil.rmtree(tempdir, ignore_errors=True)
+        _prune(os.path.dirname(entry))
+    except OSError as err:
+        logging.debug("couldn't write output cache: %s", err)
+
+def _umask():
+    '''the process umask, which can only be read by setting it'''
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+#temp files are created private, give replaced outputs the usual permissions
+FILE_MODE = 0o666 & ~_umask()
+
+def new_temp(path):
+    '''opens a temp file for writing next to path, returns (file, temp path)'''
+    handle, temppath = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    return os.fdopen(handle, 'w'), temppath
+
+def _install(temppath, path):
+    '''atomically moves a finished temp file over path'''
+    os.chmod(temppath, FILE_MODE)
+    os.replace(temppath, path)
+
+def replace_if_changed(temppath, path):
+    '''moves the finished temp file over path unless path already holds the
+    same contents, so unchanged outputs keep their mtime. returns whether
+    path was replaced'''
+    if os.path.isfile(path) and filecmp.cmp(temppath, path, shallow=False):
+        os.remove(temppath)
+        return False
+    _install(temppath, path)
+    return True
+
+def write_if_changed(path, text):
+    '''writes text to path unless it already holds exactly that, returns
+    whether it wrote'''
+    if os.path.isfile(path):
+        with open(path) as current:
+            if current.read() == text:
+                return False
+    temp, temppath = new_temp(path)
+    with temp:
+        temp.write(text)
+    _install(temppath, path)
+    return True
+
+def copy_if_changed(source_path, path):
+    '''copies source_path over path unless their contents already match,
+    returns whether it copied'''
+    if os.path.isfile(path) and filecmp.cmp(source_path, path, shallow=False):
+        return False
+    temp, temppath = new_temp(path)
+    with temp, open(source_path) as source:
+        shutil.copyfileobj(source, temp)
+    _install(temppath, path)
+    return True
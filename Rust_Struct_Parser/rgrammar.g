@@ -1,5 +1,5 @@
 //start with a value
-?start: statement+
+start: statement+
 
 //a value is 1 or mroe statements
 //?value: statement+
@@ -12,6 +12,8 @@
     | comment
     | impl
     | externcrate
+    | typealias
+    | constant
 
 //a use is made up of one or more namespaces
 //the keyword use and a semicolon
@@ -23,6 +25,11 @@ externcrate: "extern" "crate" name [optionalas] ";"
 ?optionalas: "as" name
 
 
+//type aliases and integer constants are read by the symbol index
+//(see symbol_index), the parser only has to get past them
+typealias: [ispub] "type" name "=" modifiedtype ";"
+constant: [ispub] "const" name ":" name "=" /[0-9][0-9_]*([iu](8|16|32|64|128|size))?/ ";"
+
 //define what an impl statement looks like, 
 //we're going to ignore these going forward
 impl: ["unsafe"] "impl" name "for" name "{}"
@@ -37,7 +44,7 @@ struct:  [reprc] [ispub] "struct" name "{" decl+ "}"
 //so it's optional, it can omit a trailing comma
 //for the last one
 //also allow comments inside of structs
-decl: [ispub] name ":" modifiedtype [","]
+decl: [ispub] name ":" modifiedtype [_COMMENTED_COMMA | ","]
     | comment
 
 ?ispub: "pub"
@@ -49,8 +56,8 @@ decl: [ispub] name ":" modifiedtype [","]
 ?rtype: name
     | array
 
-//arrays are a type and an int
-array: "[" modifiedtype ";" /[1-9]{1}[0-9]*/ "]"
+//arrays are a type and an int, or a constant's name
+array: "[" modifiedtype ";" (/[1-9]{1}[0-9]*/ | name) "]"
 
 //pointers are mut or const
 pointer: "*" mutable
@@ -62,9 +69,35 @@ const: "const"
 //names are alpha-start, alphanumeric/_ after
 ?name: /[a-z_A-Z][a-z_A-Z0-9]*/
 
-//we're only handling single line comments right 
-//now, might pre-process multilines out
-comment: /\/\/[^\n]*/
+//comments are kept wherever a statement or a decl could start,
+//block comments anywhere else are ignored by the lexer
+comment: LINE_COMMENT
+    | BLOCK_COMMENT
+
+LINE_COMMENT: /\/\/[^\n]*/
+
+//block comments can be nested and include doc comments. The contextual
+//lexer only offers BLOCK_COMMENT where a comment rule can follow,
+//elsewhere the identical INLINE_COMMENT matches and is ignored
+BLOCK_COMMENT.2: _NESTED_COMMENT
+INLINE_COMMENT: _NESTED_COMMENT
+
+//block comments between a field's type and its comma are dropped. Without
+//this the comment would be taken as the start of the next decl
+_COMMENTED_COMMA.3: (_NESTED_COMMENT /\s*/)+ ","
+
+//lark's regexes can't recurse, so each level of nesting is a terminal of
+//its own and comments nested deeper than _NESTED_COMMENT don't lex
+//(TreeBuilder.COMMENT_DEPTH, which has to match, makes the error say so).
+//Each alternative inside a comment takes exactly one character and no two
+//can match the same one, so an unclosed comment fails in linear time
+//instead of backtracking exponentially
+_NESTED_COMMENT: "/*" (_COMMENT_CHAR | _COMMENT_DEPTH_3)* "*/"
+_COMMENT_DEPTH_3: "/*" (_COMMENT_CHAR | _COMMENT_DEPTH_2)* "*/"
+_COMMENT_DEPTH_2: "/*" (_COMMENT_CHAR | _COMMENT_DEPTH_1)* "*/"
+_COMMENT_DEPTH_1: "/*" _COMMENT_CHAR* "*/"
+//a character that doesn't open or close a comment
+_COMMENT_CHAR: /[^*\/]|\*(?!\/)|\/(?!\*)/
 
 //define what reprc looks like
 reprc: "#[repr(C)]"
@@ -72,4 +105,5 @@ reprc: "#[repr(C)]"
 //for use by lark
 %import common.ESCAPED_STRING
 %import common.WS
-%ignore WS
\ No newline at end of file
+%ignore WS
+%ignore INLINE_COMMENT
\ No newline at end of file
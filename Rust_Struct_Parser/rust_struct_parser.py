@@ -1,387 +1,409 @@
-'''transforms rust struct file into other languages'''
+'''transforms rust struct file into other languages. lark, the parser and
+anything else only parsing needs are imported when something is parsed, so
+--help, argument errors and runs served from the output cache start quickly'''
 import argparse
+import json
 import os
-import pprint
-import re
+import sys
 import logging
-from TreeToObj import TreeToObj
-from TreeBuilder import TreeBuilder
+import shutil
+import tempfile
+import time
+from io import StringIO
+import output_cache
+from output_cache import DEFAULT_CACHE_DIR
+from ConversionStats import ConversionStats, NoStats
+from struct_layout import layout_struct, report, TARGETS, DEFAULT_TARGET
+from struct_ir import Struct
+from backends import BACKENDS, CSharpBackend, CppBackend, PythonBackend, OutputOptions
+from symbol_index import SymbolIndex, index_path
 
-#build the lookup tables
+#maps the language names used on the command line to filetype keys
+LANGUAGES = {backend.LANGUAGE: key for key, backend in BACKENDS.items()}
 
-class NoWriter:
-    '''a hacky way to handle not writing to a file we don't want to'''
-    def write(self, _):
-        '''does nothing'''
-        pass
+def language_filetypes(languages):
+    '''builds a filetypes object for convert from a list of language names'''
+    #looked up each time so backends registered after import are found
+    names = {backend.LANGUAGE: key for key, backend in BACKENDS.items()}
+    return {names[language]: None for language in languages if language in names}
 
-    def close(self):
-        '''does nothing'''
-        pass
+#file name of each filetype's output, formatted with the prefix
+OUTFILES = {key: backend.OUTFILE for key, backend in BACKENDS.items()}
+
+def _emit_phase(key):
+    '''the stats phase a backend's rendering is timed in, e.g. emit.cpp'''
+    return "emit." + BACKENDS[key].LANGUAGE
+
+def _shift_error(err, offset, lines, column):
+    '''moves a lark error's position, and the one in its message, from
+    the start of a chunk to where the chunk starts in the whole input'''
+    if not isinstance(err.line, int):
+        #the end of the input, which has no position
+        return
+    old = (err.line, err.column)
+    if err.line == 1:
+        err.column += column
+    err.line += lines
+    err.pos_in_stream += offset
+    token = getattr(err, "token", None)
+    if token is not None:
+        token.line, token.column, token.pos_in_stream = err.line, err.column, err.pos_in_stream
+    #the position is at the end of the message's first line, after anything quoted from the input
+    first, newline, rest = err.args[0].partition("\n")
+    for form in ("at line {} col {}", "at line {}, column {}"):
+        head, found, tail = first.rpartition(form.format(*old))
+        if found:
+            err.args = (head + form.format(err.line, err.column) + tail + newline + rest,)
+            break
 
 class StructConverter:
-    '''converts structs from rust to cpp, c# and python'''
-    CSTYPEMAP = {
-        #1 bit
-        'bool': 'byte',
-        #8-bits
-        # a c_char is a signed byte
-        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
-        # for why it's a signed byte, not unsigned
-        'c_char': 'sbyte',
-        'i8': 'sbyte',
-        'c_schar': 'sbyte',
-        #but a c_char that's a pointer is a string
-        'c_char_pntr': 'string',
-        'u8': 'byte',
-        'c_uchar': 'byte',
-        #16 bits
-        'u16': 'ushort',
-        'c_ushort': 'ushort',
-        'i16': 'short',
-        'c_short': 'short',
-        #32 bits
-        #ints
-        'c_void': 'IntPtr',
-        'u32': 'uint',
-        'c_uint': 'uint',
-        'i32': 'int',
-        'c_int': 'int',
-        #floats
-        'f32': 'float',
-        'c_float': 'float',
-        #64 bits
-        #ints
-        'i64': 'long',
-        'c_long': 'long',
-        'c_longlong': 'long',
-        'u64': 'ulong',
-        'c_ulong': 'ulong',
-        'c_ulonglong': 'ulong',
-        #floats
-        'c_double': 'double',
-        'f64': 'double',
-        #NOTE! i128 and other 128 bit integer/float types are still on
-        # rust nightly only, so we won't support them
-    }
+    '''converts structs from rust to cpp, c# and python, or any other language
+    with a backend, see backends'''
+    #the type maps live in the backends now, these are kept for anyone using them
+    CSTYPEMAP = CSharpBackend.TYPEMAP
+    CPPTYPEMAP = CppBackend.TYPEMAP
+    PYTYPEMAP = PythonBackend.TYPEMAP
 
-    CPPTYPEMAP = {
-        'bool': 'bool',
-        #8-bits
-        # a c_char is a signed byte
-        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
-        # for why it's a signed byte, not unsigned
-        'c_char': 'signed char',
-        'c_char_pntr': 'char*',
-        'i8': 'signed char',
-        'c_schar': 'signed char',
-        'u8': 'unsigned char',
-        'c_uchar': 'unsigned char',
-        #16 bits
-        'u16': 'unsigned short',
-        'c_ushort': 'unsigned short',
-        'i16': 'short',
-        'c_short': 'short',
-        #32 bits
-        #ints
-        'c_void': 'void*',
-        'u32': 'unsigned int',
-        'c_uint': 'unsigned int',
-        'i32': 'int',
-        'c_int': 'int',
-        #floats
-        'f32': 'float',
-        'c_float': 'float',
-        #64 bits
-        #ints
-        'i64': 'long long int',
-        'c_long': 'long long int',
-        'c_longlong': 'long long int',
-        'u64': 'unsigned long long int',
-        'c_ulong': 'unsigned long long int',
-        'c_ulonglong': 'unsigned long long int',
-        #floats
-        'c_double': 'double',
-        'f64': 'double',
-        #NOTE! i128 and other 128 bit integer/float types are still on
-        # rust nightly only, so we won't support them
-    }
+    def __init__(self, input_file, out_path, out_name, **options):
+        '''the keyword options are the converter's own, listed below, and the
+        backends' OutputOptions'''
+        #collects phase timings and counts when given a ConversionStats
+        stats = options.pop("stats", None)
+        self.stats = stats if stats is not None else NoStats()
+        #a builder can be shared between converters so the parser is only loaded once,
+        #the builder's transformer then decides whether block comments are kept.
+        #Otherwise it's loaded the first time something needs parsing, see builder
+        self._builder = options.pop("builder", None)
+        self.cache_dir = options.pop("cache_dir", DEFAULT_CACHE_DIR)
+        self.keep_block_comments = options.pop("keep_block_comments", False)
+        if self._builder is not None:
+            self.keep_block_comments = getattr(self._builder.transformer, "keep_block_comments", False)
+        #where generated outputs are cached, keyed on the input. None turns it off
+        self.output_cache_dir = options.pop("output_cache_dir", None)
+        #whether to only hand the #[repr(C)] structs to the parser
+        self.reprc_only = options.pop("reprc_only", False)
+        #the struct layouts for layout_target are worked out when reporting on them
+        #or asserting them in the c++/c# output, see struct_layout
+        self.layout_report = options.pop("layout_report", False)
+        self.layout_target = options.pop("layout_target", DEFAULT_TARGET)
+        #{name: StructLayout or None} for the structs of the last conversion
+        self.layouts = {}
+        #a symbol_index.Resolver for the aliases, constants and struct order
+        self.symbols = options.pop("symbols", None)
+        #everything else is for the backends
+        self.output = OutputOptions(**options)
+        self.in_file = input_file
+        self.out_path = out_path
+        self.out_name = out_name
 
-    PYTYPEMAP = {
-        'bool': 'c_bool',
-        #8-bits
-        # a c_char is a signed byte
-        # also, see https://doc.servo.org/std/os/raw/type.c_char.html
-        # for why it's a signed byte, not unsigned
-        'c_char': 'c_byte',
-        'c_char_pntr': 'c_char_p',
-        'i8': 'c_byte',
-        'c_schar': 'c_byte',
-        'u8': 'c_ubyte',
-        'c_uchar': 'c_ubyte',
-        #16 bits
-        'u16': 'c_ushort',
-        'c_ushort': 'c_ushort',
-        'i16': 'c_short',
-        'c_short': 'c_short',
-        #32 bits
-        #ints
-        'c_void': 'c_void_p',
-        'u32': 'c_uint',
-        'c_uint': 'c_uint',
-        'i32': 'c_int',
-        'c_int': 'c_int',
-        #floats
-        'f32': 'c_float',
-        'c_float': 'c_float',
-        #64 bits
-        #ints
-        'i64': 'c_longlong',
-        'c_long': 'c_longlong',
-        'c_longlong': 'c_longlong',
-        'u64': 'c_ulonglong',
-        'c_ulong': 'c_ulonglong',
-        'c_ulonglong': 'c_ulonglong',
-        #floats
-        'c_double': 'c_double',
-        'f64': 'c_double',
-        #NOTE! i128 and other 128 bit integer/float types are still on
-        # rust nightly only, so we won't support them
-    }
+    @property
+    def builder(self):
+        '''the TreeBuilder, loaded the first time it's needed'''
+        if self._builder is None:
+            from TreeBuilder import TreeBuilder
+            from TreeToObj import TreeToObj
+            with self.stats.phase("grammar load"):
+                self._builder = TreeBuilder(self.cache_dir, TreeToObj(self.keep_block_comments))
+        return self._builder
 
-    CSHEADERS = ["using System;", "using System.Linq;",
-                 "using System.Runtime.InteropServices;\n\n",
-                 "namespace {}\n{{"]
+    @property
+    def builder_loaded(self):
+        '''whether the parser has been loaded, or was handed in'''
+        return self._builder is not None
 
-    CPPHEADERS = ['#include <stdbool.h>', '#include <cstdint>\n',
-                  '#ifndef {0}_H', '#define {0}_H\n']
+    def _read_source(self, source):
+        '''returns source, or the input file's contents if it isn't given,
+        cut down to just the #[repr(C)] structs if asked to'''
+        if source is None:
+            with self.stats.phase("read"), open(self.in_file) as infile:
+                source = infile.read()
+        self.stats.count(files=1, bytes_in=len(source))
+        if self.reprc_only:
+            from source_scanner import filter_reprc
+            with self.stats.phase("prefilter"):
+                source = filter_reprc(source)
+        return source
 
-    #there are no extra headers for python right now
-    #we import ctypes at the end so that we only import what we need
-    PYHEADERS = []
+    def parse(self, source=None):
+        '''parses rust source, read from the input file if it isn't given,
+        into a list of transformed items'''
+        source = self._read_source(source)
+        builder = self.builder
+        #TreeToObj runs as the parser reduces, so no lark tree is built
+        with self.stats.phase("parse"):
+            xformtree = builder.parse(source)
+        #if log level is debug...
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            import pprint
+            logging.debug('======\ntransformed tree:\n======\n')
+            logging.debug(pprint.pformat(xformtree))
+        return xformtree
 
-    def __init__(self, input_file, out_path, out_name):
-        self.builder = TreeBuilder()
-        self.xformer = TreeToObj()
-        self.xformtree = None
-        self.in_file = input_file
-        self.out_path = out_path
-        self.out_name = out_name
-        self.multiline_regex = re.compile(r"/\*(?:(?!\*/).)*\*/", re.DOTALL) # pylint: disable=E1101
-        #if the output path doesn't exist, create it
-        if not os.path.exists(self.out_path):
-            os.makedirs(self.out_path)
+    def parse_iter(self, source=None):
+        '''parses rust source, or the input file a chunk at a time if it isn't
+        given, yielding each top-level item as soon as its chunk is parsed'''
+        if source is None and not self.reprc_only:
+            self.stats.count(files=1, bytes_in=os.path.getsize(self.in_file))
+            with open(self.in_file) as infile:
+                yield from self._parse_chunks(infile)
+        else:
+            #the pre-filter needs the whole file, but only passes the structs on
+            yield from self._parse_chunks(StringIO(self._read_source(source)))
 
-    def _comment_pre_processor(self):
-        '''removes multiline comments from the input file'''
-        with open(self.in_file) as infile:
-            content = infile.read()
-        with open('temp_infile.temp', 'w') as tempfile:
-            tempfile.write(self.multiline_regex.sub('', content))
+    def _parse_chunks(self, stream):
+        '''parses the statement-aligned chunks of a stream one by one'''
+        from lark.exceptions import UnexpectedInput
+        from source_scanner import split_statements
+        builder = self.builder
+        chunks = split_statements(stream)
+        #where the chunk starts in the stream: characters, lines and column
+        offset = lines = column = 0
+        while True:
+            with self.stats.phase("read"):
+                chunk = next(chunks, None)
+            if chunk is None:
+                return
+            try:
+                with self.stats.phase("parse"):
+                    items = builder.parse(chunk)
+            except UnexpectedInput as err:
+                #positions in the error are relative to the chunk
+                _shift_error(err, offset, lines, column)
+                raise
+            yield from items
+            offset += len(chunk)
+            newlines = chunk.count("\n")
+            lines += newlines
+            column = len(chunk) - chunk.rfind("\n") - 1 if newlines else column + len(chunk)
 
-    @staticmethod
-    def _start_file(outfile, towrite, namespace):
-        '''writes headers to a file given a file to write to,
-        lines to write, and a namespace'''
-        for line in towrite:
-            outfile.write(line.format(namespace) + "\n")
+    def _backends(self, filetypes):
+        '''a backend for each of the requested filetypes, in output order'''
+        return {key: backend(self.out_name, self.output) for key, backend in BACKENDS.items()
+                if key in filetypes}
 
-    def _write_py_headers(self, imports):
-        '''write just the python headers that we used'''
-        with open(os.path.join(self.out_path, '{}_temp.py'.format(self.out_name)), mode='r') as temp:
-            with open(os.path.join(self.out_path, '{}.py'.format(self.out_name)), mode='w') as pyf:
-                ctype_line = "from ctypes import "
-                for ctype in imports:
-                    ctype_line += "{}, ".format(ctype)
-                ctype_line = ctype_line[0:-2] + "\n\n"
-                pyf.write(ctype_line)
-                for line in temp.readlines():
-                    pyf.write(line)
-        os.remove(os.path.join(self.out_path, '{}_temp.py'.format(self.out_name)))
+    def _prepare(self, xformtree):
+        '''resolves and orders transformed items, counts the structs and lays
+        them out if asked to, yielding each item as it goes so streaming
+        stays streaming'''
+        if self.symbols is not None:
+            xformtree = self.symbols.order(self.symbols.resolve_items(xformtree))
+        self.layouts = {}
+        #earlier structs' layouts, for the structs that hold them
+        known = {}
+        for item in xformtree:
+            if isinstance(item, Struct):
+                fields = item.fields
+                self.stats.count(structs=1, fields=len(fields))
+                if self.layout_report or self.output.layout_asserts:
+                    item.layout = layout_struct(item.name, fields, self.layout_target, known)
+                    self.layouts[item.name] = item.layout
+                    if item.layout is not None:
+                        known[item.name] = item.layout
+            yield item
+        if self.layout_report:
+            print("layout of {} on {}:\n{}".format(self.in_file or self.out_name, self.layout_target,
+                                                    report(self.layouts)), file=sys.stderr)
 
-    def _write_simple_types(self, filetypes, field, pyimports):
-        '''write simple types into struct definition'''
-        filetypes["cs"].write("\t\tpublic {} {};\n".format(self.get_cs_map(field[2]), field[1]))
-        filetypes["cpp"].write("\t{} {};\n".format(self.get_cpp_map(field[2]), field[1]))
-        filetypes["pyf"].write('        ("{}", {}),\n'.format(field[1], self.get_py_map(field[2], pyimports)))
+    def _render(self, xformtree, filetypes):
+        '''renders transformed items, returns {filetype: {file name: generated source}}'''
+        backends = self._backends(filetypes)
+        with self.stats.phase("emit"):
+            items = list(self._prepare(xformtree))
+            rendered = {}
+            #each backend renders the whole of the items into its own buffer
+            for key, backend in backends.items():
+                with self.stats.phase(_emit_phase(key)):
+                    rendered[key] = backend.files(items)
+            return rendered
 
-    @staticmethod
-    def _write_interstruct_comment(filetypes, field):
-        '''write inter-comment structs into struct definition'''
-        filetypes["cs"].write("\t\t" + field[1] + "\n")
-        filetypes["cpp"].write("\t" + field[1] + "\n")
-        filetypes["pyf"].write('        #{}\n'.format(field[1].replace("//", "")))
+    def render(self, xformtree, filetypes):
+        '''renders transformed items for each of the requested filetypes,
+        returns a dict of {file name: generated source}'''
+        return {name: text for files in self._render(xformtree, filetypes).values()
+                for name, text in files.items()}
 
-    def _write_pointers(self, filetypes, field, pyimports):
-        #for c#, if it's a c_char pointer, add an extra line
-        if field[2][1] == 'c_char':
-            filetypes["cs"].write("\t\t[MarshalAs(UnmanagedType.LPStr)]\n")
-        #otherwise, look it up and write it
-        filetypes["cs"].write("\t\tpublic {} {};\n".format(self.get_cs_map(field[2][1], True), field[1]))
-        
-        #for python and c++, if it's a c_char, add _pntr to the end
-        if field[2][1] == "c_char":
-            charfield = field[2][1]+"_pntr"
-        else:
-            charfield = field[2][1]
-        filetypes["cpp"].write("\t{} {};\n".format(self.get_cpp_map(charfield), field[1]))
-        filetypes["pyf"].write('        ("{}", {}),\n'.format(field[1],
-                                                              self.get_py_map(charfield, pyimports)))
+    def write(self, xformtree, filetypes):
+        '''writes transformed items out to each of the requested filetypes,
+        leaving any output that hasn't changed untouched'''
+        rendered = self._render(xformtree, filetypes)
+        with self.stats.phase("write"):
+            for key, files in rendered.items():
+                for name, text in files.items():
+                    self._write_output(key, name, text)
+        return {name: text for files in rendered.values() for name, text in files.items()}
 
-    def _write_arrays(self, filetypes, field, pyimports):
-        arrtype = field[2][1][0]
-        arrlen = field[2][1][1]
-        is_pntr = field[2][1][2]
-        #cs
-        cstype = self.get_cs_map(arrtype, is_pntr)
-        if cstype != "string":
-            filetypes["cs"].write("\t\t[MarshalAs(UnmanagedType.ByValArray, SizeConst = {})]\n"
-                                  .format(arrlen))
-        else:
-            filetypes["cs"].write("\t\t[MarshalAs(UnmanagedType.LPArray, ArraySubType=UnmanagedType.LPStr, SizeConst={})]\n"
-                                  .format(arrlen))
-        filetypes["cs"].write("\t\tpublic {0}[] {1};\n"
-                              .format(self.get_cs_map(arrtype, is_pntr),
-                                      field[1]))
-        #cpp
-        filetypes["cpp"].write("\t{} {}[{}];\n"
-                               .format(self.get_cpp_map(arrtype), field[1], arrlen))
-        #python
-        pytowrite = '        ("{}", {} * {}),\n'.format(field[1], self.get_py_map(arrtype, pyimports), arrlen)
-        filetypes["pyf"].write(pytowrite)
+    def _write_output(self, key, name, text):
+        '''writes one output file if it changed, creating its directory'''
+        start = time.perf_counter()
+        path = os.path.join(self.out_path, name)
+        #split outputs go in a directory of their own
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        output_cache.write_if_changed(path, text)
+        self.stats.add_output(BACKENDS[key].LANGUAGE, time.perf_counter() - start, len(text))
 
-    def _build_filetypes(self, filetypes):
-        #cpp
-        if "cpp" in filetypes:
-            filetypes["cpp"] = open(os.path.join(self.out_path, '{}.h'.format(self.out_name)), mode='w')
-        else:
-            filetypes["cpp"] = NoWriter()
-        #python
-        if "pyf" in filetypes:
-            filetypes["pyf"] = open(os.path.join(self.out_path,
-                                                 '{}_temp.py'.format(self.out_name)), mode='w')
-        else:
-            filetypes["pyf"] = NoWriter()
-        #c#
-        if "cs" in filetypes:
-            filetypes["cs"] = open(os.path.join(self.out_path, '{}.cs'.format(self.out_name)), mode='w')
-        else:
-            filetypes["cs"] = NoWriter()
+    def _write_temp(self, name, text):
+        '''writes one output file to a temp file next to it, creating its
+        directory, returns the temp path'''
+        path = os.path.join(self.out_path, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        outfile, temppath = output_cache.new_temp(path)
+        with outfile:
+            outfile.write(text)
+        return temppath
 
-    def convert(self, filetypes):
-        '''runs the converter'''
-        #run the pre-processor, removes multiline comments
-        logging.debug("removing multiline comments")
-        self._comment_pre_processor()
-        logging.debug("multiline comments removed, tempfile written")
-        #runs the struct conversion
-        with open('temp_infile.temp') as infile:
-            #build the tree and pretty print it
-            tree = self.builder.get_tree(infile.read())
-            logging.debug("======\nLark Tree:\n======")
-            logging.debug(tree.pretty())
-            xformtree = self.xformer.transform(tree)
-            logging.debug('======\ntransformed tree:\n======\n')
-            #if log level is debug...
-            if logging.getLogger().isEnabledFor(logging.DEBUG):
-                pprinter = pprint.PrettyPrinter()
-                pprinter.pprint(self.xformer.transform(tree))
-            #cpp
-            self._build_filetypes(filetypes)
-            #make the start of each file
-            #cs first
-            self._start_file(filetypes["cs"], StructConverter.CSHEADERS, self.out_name)
-            #cpp
-            self._start_file(filetypes["cpp"], StructConverter.CPPHEADERS, self.out_name)
-            #python
-            self._start_file(filetypes["pyf"], StructConverter.PYHEADERS, None)
-            #for python, we don't want to import *, so we're going to start
-            #a list of our imports, the only one we know we'll need right now
-            #is Structure
-            pyimports = ["Structure"]
+    def _outputs(self, filetypes):
+        '''the (filetype, file name) of each requested output'''
+        return [(key, backend.OUTFILE.format(self.out_name)) for key, backend in BACKENDS.items()
+                if key in filetypes]
+
+    def _cache_key(self, filetypes, source):
+        '''the output cache key for this conversion, None if the cache is off'''
+        #the layout report needs the structs, so it always parses
+        if self.output_cache_dir is None or self.layout_report:
+            return None
+        settings = [sorted(filetypes), self.out_name, self.keep_block_comments, self.reprc_only,
+                    self.layout_target, None if self.symbols is None else self.symbols.settings(),
+                    self.output.settings()]
+        return output_cache.cache_key(self.in_file, source, settings)
+
+    def _write_cached(self, key):
+        '''writes the cached outputs for key if there are any, returning the
+        cache entry, or None on a miss'''
+        entry = output_cache.lookup(self.output_cache_dir, key)
+        if entry is None:
+            return None
+        logging.debug("outputs are cached, skipping the parser")
+        for name in output_cache.entry_files(entry):
+            path = os.path.join(self.out_path, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            output_cache.copy_if_changed(os.path.join(entry, name), path)
+        return entry
+
+    def _store_cached(self, key, rendered_names):
+        '''caches the outputs that were just written'''
+        if key is not None:
+            with self.stats.phase("cache store"):
+                output_cache.store(self.output_cache_dir, key,
+                                   {name: os.path.join(self.out_path, name) for name in rendered_names})
 
-            for item in xformtree:
-                if isinstance(item, tuple):
-                    #if it's a main level comment
-                    if item[0] == 'comment':
-                        filetypes["cs"].write("\t" + item[1] + "\n")
-                        filetypes["cpp"].write(item[1] + "\n")
-                        filetypes["pyf"].write(item[1].replace("//", "#") + "\n")
-                    #if it's a struct
-                    if item[0] == 'struct':
-                        ###declare the structs'''
-                        #cs
-                        filetypes["cs"].write("\t[StructLayout(LayoutKind.Sequential)]\n")
-                        filetypes["cs"].write("\tpublic struct {}\n\t{{\n".format(item[1]))
-                        #cpp
-                        filetypes["cpp"].write("typedef struct {}Tag {{\n".format(item[1]))
-                        #python
-                        filetypes["pyf"].write("class {}(Structure):\n".format(item[1]))
-                        filetypes["pyf"].write("    _fields_ = [\n")
-                        ###foreach item in the struct, write it
-                        for field in item[2]:
-                            #if it's a comment inside of a struct:
-                            if field is not None and field[0] == 'comment':
-                                self._write_interstruct_comment(filetypes, field)
-                            #if it's anything but a comment...
-                            elif field is not None:
-                                #if it's a simple type, it won't be a tuple:
-                                if not isinstance(field[2], tuple):
-                                    self._write_simple_types(filetypes, field, pyimports)
-                                #if it's a more complex type
-                                else:
-                                    #if it's a pointer:
-                                    if field[2][0][0] == 'pointer':
-                                        self._write_pointers(filetypes, field, pyimports)
-                                    #if it's an array
-                                    elif field[2][0] == 'array':
-                                        self._write_arrays(filetypes, field, pyimports)
-                        #close out the struct
-                        filetypes["cs"].write("\t}\n\n")
-                        filetypes["cpp"].write("}} {};\n\n".format(item[1]))
-                        filetypes["pyf"].write("        ]\n\n")
-            #close the cs and cpp file
-            filetypes["cs"].write("}")
-            filetypes["cpp"].write("#endif")
-            #close the files
-            for _, filetype in filetypes.items():
-                filetype.close()
-        #write python headers
-        if not isinstance(filetypes["pyf"], NoWriter):
-            self._write_py_headers(pyimports)
-        #delete temp file
-        os.remove('temp_infile.temp')
-        print("\n======\nDone\n======!")
+    def convert(self, filetypes, source=None):
+        '''runs the converter, returns a dict of {file name: generated source}'''
+        with self.stats.phase("cache lookup"):
+            key = self._cache_key(filetypes, source)
+            entry = self._write_cached(key) if key is not None else None
+        if entry is not None:
+            self.stats.count(files=1, cache_hits=1)
+            rendered = {}
+            for name in output_cache.entry_files(entry):
+                with open(os.path.join(entry, name)) as cached:
+                    rendered[name] = cached.read()
+            return rendered
+        rendered = self.write(self.parse(source), filetypes)
+        self._store_cached(key, rendered)
+        return rendered
+
+    def stream(self, filetypes, source=None):
+        '''runs the converter a struct at a time, handing each one to the backends
+        as soon as it's parsed so memory is bounded by the largest struct rather
+        than the file. The output is identical to convert's'''
+        with self.stats.phase("cache lookup"):
+            cache_key = self._cache_key(filetypes, source)
+            cached = cache_key is not None and self._write_cached(cache_key) is not None
+        if cached:
+            self.stats.count(files=1, cache_hits=1)
+            return
+        #if the output path doesn't exist, create it
+        if not os.path.exists(self.out_path):
+            os.makedirs(self.out_path)
+        backends = self._backends(filetypes)
+        #split backends hand back each file as it's finished, which goes to a temp file straight away
+        split = {key: backend for key, backend in backends.items() if backend.split}
+        backends = {key: backend for key, backend in backends.items() if not backend.split}
+        #the (filetype, file name) of each split file
+        written = []
+        writers = {}
+        #each output is written to a temp file next to it, then swapped in if it changed
+        temps = {}
+        for key, backend in backends.items():
+            if backend.PREFIXED:
+                #the start isn't known until the end, so spool the body
+                writers[key] = tempfile.TemporaryFile(mode='w+')
+            else:
+                name = backend.OUTFILE.format(self.out_name)
+                writers[key], temps[name] = output_cache.new_temp(os.path.join(self.out_path, name))
+        try:
+            with self.stats.phase("emit"):
+                for key, backend in backends.items():
+                    with self.stats.phase(_emit_phase(key)):
+                        backend.begin(writers[key])
+                for item in self._prepare(self.parse_iter(source)):
+                    for key, backend in backends.items():
+                        with self.stats.phase(_emit_phase(key)):
+                            backend.item(writers[key], item)
+                    for key, backend in split.items():
+                        with self.stats.phase(_emit_phase(key)):
+                            files = backend.split_item(item)
+                        for name, text in files:
+                            temps[name] = self._write_temp(name, text)
+                            written.append((key, name))
+                for key, backend in backends.items():
+                    with self.stats.phase(_emit_phase(key)):
+                        backend.end(writers[key])
+                for key, backend in split.items():
+                    with self.stats.phase(_emit_phase(key)):
+                        files = backend.split_end()
+                    for name, text in files:
+                        temps[name] = self._write_temp(name, text)
+                        written.append((key, name))
+            for key, backend in backends.items():
+                if backend.PREFIXED:
+                    name = backend.OUTFILE.format(self.out_name)
+                    outfile, temps[name] = output_cache.new_temp(os.path.join(self.out_path, name))
+                    with outfile:
+                        outfile.write(backend.prefix())
+                        writers[key].seek(0)
+                        shutil.copyfileobj(writers[key], outfile)
+            for writer in writers.values():
+                writer.close()
+            with self.stats.phase("write"):
+                #nothing is swapped in until the whole input has converted
+                for key, name in self._outputs(backends) + written:
+                    start = time.perf_counter()
+                    size = os.path.getsize(temps[name])
+                    output_cache.replace_if_changed(temps.pop(name), os.path.join(self.out_path, name))
+                    self.stats.add_output(BACKENDS[key].LANGUAGE, time.perf_counter() - start, size)
+        finally:
+            for writer in writers.values():
+                writer.close()
+            #clean up after a failed conversion
+            for temppath in temps.values():
+                os.remove(temppath)
+        self._store_cached(cache_key, [name for _, name in self._outputs(backends) + written])
+
+    def generate(self, filetypes, source=None):
+        '''runs the converter without touching the disk, returns a dict of
+        {file name: generated source}'''
+        return self.render(self.parse(source), filetypes)
 
     @staticmethod
     def get_cs_map(key, ispointer=False):
         '''gets from c-sharp type map'''
-        if key in StructConverter.CSTYPEMAP:
-            #handle if it's a c_char pointer
-            if ispointer and key == "c_char":
-                key = key + "_pntr"
-            return StructConverter.CSTYPEMAP[key]
-        return key
+        return CSharpBackend.get_map(key, ispointer)
 
     @staticmethod
     def get_cpp_map(key):
         '''gets from cpp type map'''
-        if key in StructConverter.CPPTYPEMAP:
-            return StructConverter.CPPTYPEMAP[key]
-        return key
+        return CppBackend.get_map(key)
 
     @staticmethod
     def get_py_map(key, used_keys):
         '''gets from python type map'''
-        if key in StructConverter.PYTYPEMAP:
-            if StructConverter.PYTYPEMAP[key] not in used_keys:
-                used_keys.append(StructConverter.PYTYPEMAP[key])
-            return StructConverter.PYTYPEMAP[key]
-        return key
+        return PythonBackend.get_map(key, used_keys)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Translate Rust structs into other languages. ")# pylint: disable=C0103
-    parser.add_argument("input_file", help="The Rust struct to translate")
+    parser.add_argument("input_file", nargs="*",
+                        help="The Rust struct file to translate. Several files, directories or globs convert every .rs file found") # pylint: disable=C0301
     parser.add_argument("-o", "--output_path", help="The path to output to", default="output")
     parser.add_argument("-p", "--prefix", help="The namespace/filename prefix for the output files",
                         default="output")
@@ -390,21 +412,121 @@ if __name__ == "__main__":
                         default=["python", "cpp", "csharp"],
                         nargs="*")
     parser.add_argument("-v", "--verbose", help="turn verbosity on or off", action="store_true")
+    parser.add_argument("--keep_block_comments", action="store_true",
+                        help="Carry block comments between structs and fields over like line comments")
+    parser.add_argument("-r", "--reprc_only", action="store_true",
+                        help="Skip everything but #[repr(C)] structs and the comments above them, for converting whole crates") # pylint: disable=C0301
+    parser.add_argument("--blittable_cs", action="store_true",
+                        help="Write unsafe C# structs with fixed buffers and raw pointers, which are passed without marshaling") # pylint: disable=C0301
+    parser.add_argument("--numpy", action="store_true",
+                        help="Also write a numpy dtype for each Python struct, plus helpers for viewing memory as arrays of them") # pylint: disable=C0301
+    parser.add_argument("--split_python", action="store_true",
+                        help="Write the Python output as a package with a module per struct, each imported on first use") # pylint: disable=C0301
+    parser.add_argument("--split_cpp", action="store_true",
+                        help="Write a C++ header per struct, a header of forward declarations and one including them all") # pylint: disable=C0301
+    parser.add_argument("--layout_report", action="store_true",
+                        help="Report each struct's size, padding and a field order that wastes less")
+    parser.add_argument("--layout_asserts", action="store_true",
+                        help="Check struct layouts at compile time: static_asserts in C++, Size= in C#")
+    parser.add_argument("--layout_target", choices=sorted(TARGETS), default=DEFAULT_TARGET,
+                        help="The target struct layouts are worked out for (default: %(default)s)")
+    parser.add_argument("-s", "--stream", action="store_true",
+                        help="Convert struct by struct to keep memory low on very large inputs")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                        help="Number of worker processes for batch conversion (default: one per CPU)")
+    parser.add_argument("-m", "--merge", action="store_true",
+                        help="In batch mode, write every struct into one set of files named after the prefix")
+    parser.add_argument("-w", "--watch", action="store_true",
+                        help="Keep running and regenerate the outputs whenever an input changes")
+    parser.add_argument("--poll_interval", type=float, default=0.05,
+                        help="In watch mode without inotify, how often to check the inputs, in seconds")
+    parser.add_argument("--debounce", type=float, default=0.002,
+                        help="In watch mode, how long the inputs must stay unchanged before regenerating, in seconds") # pylint: disable=C0301
+    parser.add_argument("--serve", action="store_true",
+                        help="Answer line-delimited JSON-RPC convert requests on stdin/stdout instead of converting input files") # pylint: disable=C0301
+    parser.add_argument("--socket", metavar="PATH",
+                        help="With --serve, listen on a unix socket at PATH instead of stdin/stdout")
+    parser.add_argument("--timings", action="store_true",
+                        help="Report how long each phase took, struct counts and throughput")
+    parser.add_argument("--profile", action="store_true",
+                        help="Like --timings, but also trace peak memory per phase (slower)")
+    parser.add_argument("--timings_json", metavar="PATH",
+                        help="Write the timings as JSON to PATH")
+    parser.add_argument("--parser_cache", help="Where to cache the compiled parser and generated outputs",
+                        default=DEFAULT_CACHE_DIR)
+    parser.add_argument("--no_parser_cache", help="Always compile the parser from the grammar",
+                        action="store_true")
+    parser.add_argument("--no_output_cache", help="Always parse the input, even if it hasn't changed",
+                        action="store_true")
     #parse the args
     args = parser.parse_args() # pylint: disable=C0103
-    #build struct converter
-    SC = StructConverter(args.input_file, args.output_path, args.prefix)
-    #build filetypes object
-    FILES = {}
-    for language in args.languages:
-        if language == "python":
-            FILES["pyf"] = None
-        elif language == "cpp":
-            FILES["cpp"] = None
-        elif language == "csharp":
-            FILES["cs"] = None
+    if not args.input_file and not args.serve:
+        parser.error("the following arguments are required: input_file")
     if args.verbose:
         logging.basicConfig(level=logging.DEBUG, format='%(message)s')
     else:
         logging.basicConfig(level=logging.WARN, format='%(message)s')
-    SC.convert(FILES)
+    CACHE_DIR = None if args.no_parser_cache else args.parser_cache
+    OPTIONS = {"reprc_only": args.reprc_only, "blittable_cs": args.blittable_cs,
+               "numpy_dtypes": args.numpy, "split_python": args.split_python,
+               "split_cpp": args.split_cpp,
+               "layout_report": args.layout_report, "layout_asserts": args.layout_asserts,
+               "layout_target": args.layout_target,
+               "output_cache_dir": None if args.no_output_cache else args.parser_cache}
+    STATS = None
+    if args.timings or args.profile or args.timings_json:
+        STATS = ConversionStats(trace_memory=args.profile)
+    if args.serve:
+        from conversion_server import Server
+        SERVER = Server(args.jobs, CACHE_DIR, args.keep_block_comments, **OPTIONS)
+        try:
+            if args.socket:
+                SERVER.serve_socket(args.socket)
+            else:
+                SERVER.serve(sys.stdin, sys.stdout)
+        except KeyboardInterrupt:
+            pass
+        except FileExistsError as err:
+            parser.error(str(err))
+        finally:
+            SERVER.close()
+        #stdout belongs to the protocol
+        sys.exit(0)
+    if args.watch:
+        from file_watcher import Watcher
+        WATCHER = Watcher(args.input_file, args.output_path, args.languages, args.prefix, args.merge,
+                          CACHE_DIR, args.keep_block_comments, args.stream, **OPTIONS)
+        try:
+            WATCHER.watch(args.poll_interval, args.debounce)
+        except KeyboardInterrupt:
+            pass
+    elif len(args.input_file) == 1 and os.path.isfile(args.input_file[0]) and not args.merge:
+        #the file's own aliases and constants, rescanned only if it changed
+        INDEX = SymbolIndex(index_path(CACHE_DIR, args.input_file))
+        INDEX.update(args.input_file)
+        INDEX.save()
+        #build struct converter
+        SC = StructConverter(args.input_file[0], args.output_path, args.prefix, cache_dir=CACHE_DIR,
+                             keep_block_comments=args.keep_block_comments, stats=STATS,
+                             symbols=INDEX.resolver(args.input_file[0]), **OPTIONS)
+        #build filetypes object
+        FILES = language_filetypes(args.languages)
+        if args.stream:
+            SC.stream(FILES)
+        else:
+            SC.convert(FILES)
+    else:
+        from batch_converter import convert_batch
+        FAILURES = convert_batch(args.input_file, args.output_path, args.languages, args.prefix,
+                                 args.merge, args.jobs, CACHE_DIR, args.keep_block_comments,
+                                 args.stream, STATS, **OPTIONS)
+        for failed, error in FAILURES:
+            logging.error("failed to convert %s: %s", failed, error)
+        if FAILURES:
+            sys.exit(1)
+    if STATS is not None and (args.timings or args.profile):
+        print(STATS.report(), file=sys.stderr)
+    if args.timings_json:
+        with open(args.timings_json, 'w') as timings_file:
+            json.dump(STATS.as_dict(), timings_file, indent=2)
+    print("\n======\nDone\n======!")
@@ -0,0 +1,265 @@
+'''cheap scanning of rust source that runs ahead of the parser'''
+import re
+
+#how much source to read at a time, and roughly how big each piece handed to the parser is
+CHUNK_SIZE = 64 * 1024
+
+#outside of comments we only need to see comments starting and what opens,
+#closes or ends a statement, inside block comments only their nesting matters
+_CODE_EVENTS = re.compile(r"//[^\n]*|/\*|[{};]")
+_COMMENT_EVENTS = re.compile(r"/\*|\*/")
+
+def split_statements(stream, chunk_size=CHUNK_SIZE):
+    '''reads a file-like stream and yields its text in pieces of roughly
+    chunk_size characters, only ever splitting right after a top-level
+    statement so each piece parses on its own'''
+    pending = ""
+    #how far into pending we've scanned, and where the last top-level statement ended
+    scanned = 0
+    cut = 0
+    depth = 0
+    comment_depth = 0
+    eof = False
+    while not eof:
+        block = stream.read(chunk_size)
+        eof = not block
+        pending += block
+        pos = scanned
+        while True:
+            pattern = _COMMENT_EVENTS if comment_depth else _CODE_EVENTS
+            match = pattern.search(pending, pos)
+            if match is None:
+                #the last character might start a two character token
+                pos = max(pos, len(pending) - 1)
+                break
+            token = match.group()
+            if token.startswith("//"):
+                #the rest of the line hasn't been read yet
+                if match.end() == len(pending) and not eof:
+                    pos = match.start()
+                    break
+            elif token == "/*":
+                comment_depth += 1
+            elif token == "*/":
+                comment_depth -= 1
+            elif token == "{":
+                depth += 1
+            elif token == "}":
+                depth -= 1
+                if depth == 0:
+                    cut = match.end()
+            elif depth == 0:
+                #a semicolon ending a use or extern crate
+                cut = match.end()
+            pos = match.end()
+        scanned = pos
+        if cut >= chunk_size:
+            yield pending[:cut]
+            pending = pending[cut:]
+            scanned -= cut
+            cut = 0
+    if pending.strip():
+        yield pending
+
+#everything the #[repr(C)] pre-filter has to step over in arbitrary rust
+#code: comments, string/char literals (which can hide braces and fake
+#attributes) and outer attributes, one of which is the #[repr(C)] it's
+#looking for. The lookahead covers every alternative so re throws out
+#most positions on their first character, raw strings are picked out of
+#the string matches by _raw_string_end
+_ITEM_EVENTS = re.compile(r'''
+    (?=[/"'\#])
+    (?:(?P<line>//[^\n]*)
+    |(?P<block>/\*)
+    |(?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<char>'(?:[^'\\\n]|\\(?:x[0-9a-fA-F]{2}|u\{[0-9a-fA-F]+\}|.))')
+    |(?P<attr>\#\[[^\]]*\]))
+    ''', re.VERBOSE | re.DOTALL)
+_REPRC = "#[repr(C)]"
+_SPACE = re.compile(r"\s*")
+#what has to follow a #[repr(C)] and its comments and other attributes
+_STRUCT_HEAD = re.compile(r"\s*(?P<head>pub\s+struct\s+[A-Za-z_][A-Za-z_0-9]*\s*\{)")
+_BODY_EVENTS = re.compile(r"//[^\n]*|/\*|[{}]")
+
+_RAW_PREFIX = re.compile(r"(?<![A-Za-z0-9_])b?r(#*)$")
+
+def _raw_string_end(source, quote):
+    '''if the quote at quote opens a raw string (r"..", r#".."#, br".."),
+    returns where it ends, otherwise None'''
+    #a raw string prefix is at most a few characters, don't look further back
+    prefix = _RAW_PREFIX.search(source, max(0, quote - 16), quote)
+    if prefix is None:
+        return None
+    closing = '"' + prefix.group(1)
+    end = source.find(closing, quote + 1)
+    return len(source) if end == -1 else end + len(closing)
+
+def _skip_block_comment(source, pos):
+    '''returns the end of the (possibly nested) block comment opened just before pos'''
+    depth = 1
+    while depth:
+        match = _COMMENT_EVENTS.search(source, pos)
+        if match is None:
+            return len(source)
+        depth += 1 if match.group() == "/*" else -1
+        pos = match.end()
+    return pos
+
+def _match_brace(source, pos):
+    '''returns the end of the struct body whose opening brace is just before pos'''
+    depth = 1
+    while depth:
+        match = _BODY_EVENTS.search(source, pos)
+        if match is None:
+            return len(source)
+        token = match.group()
+        if token == "{":
+            depth += 1
+        elif token == "}":
+            depth -= 1
+        elif token == "/*":
+            pos = _skip_block_comment(source, match.end())
+            continue
+        pos = match.end()
+    return pos
+
+def _reprc_text(source, run, head):
+    '''returns the end of a #[repr(C)] struct's body and its text from the
+    start of the comments and attributes in run. Attributes other than
+    #[repr(C)] are swapped for their newlines so lines still match up, and
+    if a comment comes after #[repr(C)] it's moved down to the struct
+    since the grammar wants it right before pub'''
+    reprc = next(start for kind, start, end in run if kind == "attr" and source[start:end] == _REPRC)
+    moved = any(kind != "attr" and start > reprc for kind, start, end in run)
+    pieces = []
+    last = run[0][1]
+    for kind, start, end in run:
+        if kind == "attr" and (start != reprc or moved):
+            pieces.append(source[last:start])
+            pieces.append("\n" * source.count("\n", start, end))
+            last = end
+    pieces.append(source[last:head.start("head")])
+    if moved:
+        pieces.append(_REPRC + " ")
+    end = _match_brace(source, head.end())
+    pieces.append(source[head.start("head"):end])
+    return end, "".join(pieces)
+
+def find_reprc_items(source):
+    '''yields (start, end, text) for every #[repr(C)] pub struct in source,
+    together with the comments directly above it, which can be mixed in
+    with its attributes in any order. Any other attributes are blanked
+    out of text'''
+    pos = 0
+    #the comments and attributes seen since the last bit of code, as (kind, start, end)
+    run = []
+    reprc_in_run = False
+    next_reprc = source.find(_REPRC)
+    while True:
+        if next_reprc != -1 and next_reprc < pos:
+            next_reprc = source.find(_REPRC, pos)
+        #once there's no #[repr(C)] left the rest of the source can't hold an item
+        if next_reprc == -1 and not reprc_in_run:
+            return
+        match = _ITEM_EVENTS.search(source, pos)
+        if match is None:
+            return
+        kind = match.lastgroup
+        start = match.start()
+        end = match.end()
+        #only comments and attributes separated by whitespace count as directly above
+        if run and _SPACE.match(source, run[-1][2]).end() != start:
+            run = []
+            reprc_in_run = False
+        if kind == "block":
+            end = _skip_block_comment(source, end)
+        elif kind == "string":
+            end = _raw_string_end(source, start) or end
+        pos = end
+        if kind in ("string", "char"):
+            #a literal, step over it
+            run = []
+            reprc_in_run = False
+            continue
+        run.append((kind, start, end))
+        if kind == "attr" and source[start:end] == _REPRC:
+            reprc_in_run = True
+        if not reprc_in_run:
+            continue
+        head = _STRUCT_HEAD.match(source, end)
+        if head is None:
+            continue
+        pos, text = _reprc_text(source, run, head)
+        yield run[0][1], pos, text
+        run = []
+        reprc_in_run = False
+
+def filter_reprc(source):
+    '''keeps only the #[repr(C)] structs (and their comments) from source,
+    blanking out everything else but the newlines so that line numbers
+    in parse errors still point at the original file'''
+    kept = []
+    last = 0
+    for start, end, text in find_reprc_items(source):
+        kept.append("\n" * source.count("\n", last, start))
+        kept.append(text)
+        last = end
+    kept.append("\n" * source.count("\n", last))
+    return "".join(kept)
+
+#what the symbol index needs from a file, stepping over comments and
+#literals like _ITEM_EVENTS (with the lookahead covering every
+#alternative): #[repr(C)] structs, type aliases and integer constants.
+#Only the forms the grammar accepts are picked up
+_NAME = r"[A-Za-z_][A-Za-z_0-9]*"
+_SYMBOL_EVENTS = re.compile(r'''
+    (?=[/"'\#tc])
+    (?:(?P<line>//[^\n]*)
+    |(?P<block>/\*)
+    |(?P<string>"(?:[^"\\]|\\.)*")
+    |(?P<char>'(?:[^'\\\n]|\\(?:x[0-9a-fA-F]{2}|u\{[0-9a-fA-F]+\}|.))')
+    |\#\[repr\(C\)\](?:\s*\#\[[^\]]*\])*\s*pub\s+struct\s+(?P<struct>NAME)\s*\{
+    |(?<![A-Za-z_0-9])type\s+(?P<alias>NAME)\s*=\s*(?P<target>[^;{}]*?)\s*;
+    |(?<![A-Za-z_0-9])const\s+(?P<const>NAME)\s*:\s*NAME\s*=\s*(?P<value>[0-9][0-9_]*)
+        (?:[iu](?:8|16|32|64|128|size))?\s*;)
+    '''.replace("NAME", _NAME), re.VERBOSE | re.DOTALL)
+_FIELD = re.compile(r"(?<![A-Za-z_0-9])pub\s+({0})\s*:\s*([^,]+)".format(_NAME))
+_LINE_COMMENT = re.compile(r"//[^\n]*")
+
+def _strip_comments(text):
+    '''text with its comments blanked out'''
+    pieces = []
+    pos = 0
+    while True:
+        start = text.find("/*", pos)
+        if start == -1:
+            pieces.append(text[pos:])
+            break
+        pieces.append(text[pos:start] + " ")
+        pos = _skip_block_comment(text, start + 2)
+    return _LINE_COMMENT.sub("", "".join(pieces))
+
+def find_symbols(source):
+    '''yields what source defines that other files can use: ("struct", name,
+    [(field, type text), ...]) for each #[repr(C)] pub struct with its
+    public fields, ("alias", name, type text) for each type alias and
+    ("const", name, value) for each integer constant'''
+    pos = 0
+    while True:
+        match = _SYMBOL_EVENTS.search(source, pos)
+        if match is None:
+            return
+        pos = match.end()
+        if match.group("block") is not None:
+            pos = _skip_block_comment(source, pos)
+        elif match.group("string") is not None:
+            pos = _raw_string_end(source, match.start()) or pos
+        elif match.group("struct") is not None:
+            pos = _match_brace(source, pos)
+            body = _strip_comments(source[match.end():pos - 1])
+            yield "struct", match.group("struct"), [(field.group(1), field.group(2).strip())
+                                                    for field in _FIELD.finditer(body)]
+        elif match.group("alias") is not None:
+            yield "alias", match.group("alias"), match.group("target")
+        elif match.group("const") is not None:
+            yield "const", match.group("const"), int(match.group("value").replace("_", ""))
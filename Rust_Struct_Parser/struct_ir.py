@@ -0,0 +1,79 @@
+'''the intermediate representation TreeToObj builds and the backends render'''
+
+class Comment:
+    '''a line comment, or a kept block comment, with its // or /* */'''
+    __slots__ = ("text",)
+
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return "Comment({!r})".format(self.text)
+
+class PointerType:
+    '''a raw pointer to a named type'''
+    __slots__ = ("mutable", "target")
+
+    def __init__(self, mutable, target=None):
+        self.mutable = mutable
+        self.target = target
+
+    def __repr__(self):
+        return "PointerType({!r}, {!r})".format(self.mutable, self.target)
+
+class ArrayType:
+    '''a fixed size array of a named type, or of pointers to it'''
+    __slots__ = ("element", "length", "pointer")
+
+    def __init__(self, element, length, pointer=False):
+        self.element = element
+        #kept as written, it goes straight into the output
+        self.length = length
+        self.pointer = pointer
+
+    def __repr__(self):
+        return "ArrayType({!r}, {!r}, {!r})".format(self.element, self.length, self.pointer)
+
+class Field:
+    '''a public struct field, whose type is a type name, a PointerType or an ArrayType'''
+    __slots__ = ("name", "type")
+
+    def __init__(self, name, ftype):
+        self.name = name
+        self.type = ftype
+
+    def __repr__(self):
+        return "Field({!r}, {!r})".format(self.name, self.type)
+
+class Struct:
+    '''a #[repr(C)] pub struct. members holds its Fields and Comments in
+    order, layout is filled in with its StructLayout when one is needed'''
+    __slots__ = ("name", "members", "layout")
+
+    def __init__(self, name, members):
+        self.name = name
+        self.members = members
+        self.layout = None
+
+    @property
+    def fields(self):
+        '''just the fields, without the comments'''
+        return [member for member in self.members if isinstance(member, Field)]
+
+    def __repr__(self):
+        return "Struct({!r}, {!r})".format(self.name, self.members)
+
+class Import:
+    '''structs a file uses from another input's output. prefix is that
+    output's name, path the directory it's in relative to this output's
+    and package the same directory relative to the output root, dotted'''
+    __slots__ = ("prefix", "path", "package", "names")
+
+    def __init__(self, prefix, path, package, names):
+        self.prefix = prefix
+        self.path = path
+        self.package = package
+        self.names = names
+
+    def __repr__(self):
+        return "Import({!r}, {!r}, {!r}, {!r})".format(self.prefix, self.path, self.package, self.names)
@@ -0,0 +1,109 @@
+'''works out the #[repr(C)] layout of parsed structs: field offsets,
+size, alignment, how much of it is padding and an order that wastes less'''
+from collections import namedtuple
+from struct_ir import PointerType, ArrayType
+
+#what differs between targets: pointer size, the size of c_long and the
+#alignment of 8 byte integers and doubles
+TARGETS = {
+    "x86_64-linux": {"pointer": 8, "c_long": 8, "align8": 8},
+    "x86_64-windows": {"pointer": 8, "c_long": 4, "align8": 8},
+    "aarch64-linux": {"pointer": 8, "c_long": 8, "align8": 8},
+    "i686-linux": {"pointer": 4, "c_long": 4, "align8": 4},
+    "i686-windows": {"pointer": 4, "c_long": 4, "align8": 8},
+}
+DEFAULT_TARGET = "x86_64-linux"
+
+#sizes of the primitive types, each aligned to its size unless noted in TARGETS
+PRIMITIVES = {
+    'bool': 1, 'i8': 1, 'u8': 1, 'c_char': 1, 'c_schar': 1, 'c_uchar': 1,
+    'i16': 2, 'u16': 2, 'c_short': 2, 'c_ushort': 2,
+    'i32': 4, 'u32': 4, 'c_int': 4, 'c_uint': 4, 'f32': 4, 'c_float': 4,
+    'i64': 8, 'u64': 8, 'c_longlong': 8, 'c_ulonglong': 8, 'f64': 8, 'c_double': 8,
+}
+#types whose size is the target's
+TARGET_SIZED = {'c_long': "c_long", 'c_ulong': "c_long", 'isize': "pointer", 'usize': "pointer"}
+
+#name, offset, size and alignment of a field
+FieldLayout = namedtuple("FieldLayout", ["name", "offset", "size", "align"])
+#fields in declared order, the size and alignment of the struct, the bytes
+#lost to padding and the field names in an order that minimises the size
+StructLayout = namedtuple("StructLayout", ["name", "fields", "size", "align", "padding",
+                                           "suggested_order", "suggested_size"])
+
+def _align_up(offset, align):
+    return (offset + align - 1) // align * align
+
+def _scalar_layout(rtype, target, known):
+    '''(size, alignment) of a named type, None if it isn't known'''
+    if rtype in PRIMITIVES:
+        size = PRIMITIVES[rtype]
+        return size, target["align8"] if size == 8 else size
+    if rtype in TARGET_SIZED:
+        size = target[TARGET_SIZED[rtype]]
+        return size, size
+    if rtype in known:
+        return known[rtype].size, known[rtype].align
+    return None
+
+def field_layout(ftype, target, known):
+    '''(size, alignment) of a field's type, None if it isn't known.
+    known maps the names of structs already laid out to their StructLayout'''
+    if isinstance(ftype, PointerType):
+        return target["pointer"], target["pointer"]
+    if isinstance(ftype, ArrayType):
+        element = (target["pointer"], target["pointer"]) if ftype.pointer \
+            else _scalar_layout(ftype.element, target, known)
+        #a length that's still a name is a constant that wasn't found
+        if element is None or not ftype.length.isdigit():
+            return None
+        return element[0] * int(ftype.length), element[1]
+    return _scalar_layout(ftype, target, known)
+
+def _place(fields):
+    '''lays out (name, size, align) in order, returns (field layouts, size, align)'''
+    placed = []
+    offset = 0
+    align = 1
+    for name, size, field_align in fields:
+        offset = _align_up(offset, field_align)
+        placed.append(FieldLayout(name, offset, size, field_align))
+        offset += size
+        align = max(align, field_align)
+    return placed, _align_up(offset, align), align
+
+def layout_struct(name, fields, target=DEFAULT_TARGET, known=None):
+    '''lays out a struct's Fields for target (a TARGETS name), returns a
+    StructLayout or None if a field's type isn't known'''
+    target = TARGETS[target]
+    known = known if known is not None else {}
+    sized = []
+    for field in fields:
+        layout = field_layout(field.type, target, known)
+        if layout is None:
+            return None
+        sized.append((field.name, layout[0], layout[1]))
+    placed, size, align = _place(sized)
+    #biggest alignment first never leaves a gap between fields, since
+    #every size is a multiple of its alignment
+    reordered = sorted(sized, key=lambda field: -field[2])
+    _, suggested_size, _ = _place(reordered)
+    return StructLayout(name, placed, size, align, size - sum(field.size for field in placed),
+                        [field[0] for field in reordered], suggested_size)
+
+def report(layouts):
+    '''a human readable summary of {name: StructLayout or None}'''
+    lines = []
+    for name, layout in layouts.items():
+        if layout is None:
+            lines.append("{}: unknown layout, it holds a type that isn't defined here".format(name))
+            continue
+        waste = 100.0 * layout.padding / layout.size if layout.size else 0.0
+        lines.append("{}: {} bytes, align {}, {} bytes padding ({:.0f}%)".format(
+            name, layout.size, layout.align, layout.padding, waste))
+        for field in layout.fields:
+            lines.append("    {:>6}  {:<24} {} bytes".format(field.offset, field.name, field.size))
+        if layout.suggested_size < layout.size:
+            lines.append("    reordering as {} would make it {} bytes".format(
+                ", ".join(layout.suggested_order), layout.suggested_size))
+    return "\n".join(lines)
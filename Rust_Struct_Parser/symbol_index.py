@@ -0,0 +1,325 @@
+'''an index of the structs, type aliases and constants defined across all of
+the inputs, so a field can use a type from another file. It's kept on disk
+between runs and only files that changed are rescanned'''
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+from struct_ir import PointerType, ArrayType, Field, Struct, Import
+
+#bumped whenever what's stored changes, older indexes are rebuilt
+INDEX_VERSION = 1
+
+_NAME = r"[A-Za-z_][A-Za-z_0-9]*"
+_SIMPLE = re.compile(_NAME + "$")
+_POINTER = re.compile(r"\*\s*(mut|const)\s+({0})$".format(_NAME))
+_ARRAY = re.compile(r"\[\s*(\*\s*(?:mut|const)\s+)?({0})\s*;\s*([0-9]+|{0})\s*\]$".format(_NAME))
+
+def parse_type(text):
+    '''turns a type as written into the IR, None if it isn't a form the
+    converter handles'''
+    text = text.strip()
+    if _SIMPLE.match(text):
+        return text
+    match = _POINTER.match(text)
+    if match:
+        return PointerType(match.group(1) == "mut", match.group(2))
+    match = _ARRAY.match(text)
+    if match:
+        return ArrayType(match.group(2), match.group(3), match.group(1) is not None)
+    return None
+
+def _type_names(ftype):
+    '''the names a type uses'''
+    if isinstance(ftype, PointerType):
+        return [ftype.target]
+    if isinstance(ftype, ArrayType):
+        return [ftype.element, ftype.length]
+    return [] if ftype is None else [ftype]
+
+def index_path(cache_dir, inputs):
+    '''where the index for a set of inputs (files, directories or globs) is
+    kept, None if cache_dir is'''
+    if cache_dir is None:
+        return None
+    key = hashlib.sha256(repr(sorted(os.path.abspath(entry) for entry in inputs)).encode("utf-8"))
+    return os.path.join(cache_dir, "symbols", key.hexdigest()[:32] + ".json")
+
+class Resolver:
+    '''what one output needs from the index: the type aliases and constants
+    its structs use, and the names of the structs defined in it'''
+    def __init__(self, aliases=None, constants=None, defined=()):
+        #{name: type as IR}, {name: value} and {name}
+        self.aliases = aliases or {}
+        self.constants = constants or {}
+        self.defined = set(defined)
+
+    def settings(self):
+        '''everything that changes the output, for the output cache key'''
+        return (sorted((name, repr(ftype)) for name, ftype in self.aliases.items()),
+                sorted(self.constants.items()), sorted(self.defined))
+
+    def _alias(self, name, seen):
+        '''what name stands for if it's an alias, fully resolved, otherwise None'''
+        if name not in self.aliases or name in seen:
+            return None
+        return self.resolve_type(self.aliases[name], seen + (name,))
+
+    def resolve_type(self, ftype, seen=()):
+        '''ftype with any aliases and named array lengths replaced'''
+        if isinstance(ftype, PointerType):
+            target = self._alias(ftype.target, seen)
+            if target is None:
+                return ftype
+            #a pointer to a pointer or an array is just an address
+            return PointerType(ftype.mutable, target if isinstance(target, str) else "c_void")
+        if isinstance(ftype, ArrayType):
+            length = str(self.constants.get(ftype.length, ftype.length))
+            element, pointer = ftype.element, ftype.pointer
+            target = self._alias(element, seen)
+            if isinstance(target, str):
+                element = target
+            elif isinstance(target, PointerType) and not pointer:
+                element, pointer = target.target, True
+            elif target is not None:
+                element, pointer = "c_void", True
+            if (element, length, pointer) == (ftype.element, ftype.length, ftype.pointer):
+                return ftype
+            return ArrayType(element, length, pointer)
+        target = self._alias(ftype, seen)
+        return ftype if target is None else target
+
+    def resolve_items(self, xformtree):
+        '''resolves the fields of each struct in transformed items as they go
+        past. The structs are copied, not changed, as the watcher keeps the
+        parsed items to resolve again once an alias or constant changes'''
+        for item in xformtree:
+            if isinstance(item, Struct) and (self.aliases or self.constants):
+                item = Struct(item.name, [Field(member.name, self.resolve_type(member.type))
+                                          if isinstance(member, Field) else member
+                                          for member in item.members])
+            yield item
+
+    def _held(self, struct):
+        '''the structs defined in this output that struct holds by value'''
+        held = []
+        for field in struct.fields:
+            ftype = field.type
+            if isinstance(ftype, ArrayType) and not ftype.pointer:
+                ftype = ftype.element
+            if isinstance(ftype, str) and ftype in self.defined and ftype != struct.name:
+                held.append(ftype)
+        return held
+
+    def order(self, xformtree):
+        '''yields transformed items with every struct after the structs it
+        holds by value, so c++ and the layouts see them first. Comments stay
+        with the struct after them. Only structs that come before something
+        they hold are held back, until it arrives'''
+        emitted = set()
+        #{struct name: the (position, items) waiting for it}
+        waiting = {}
+        comments = []
+        for position, item in enumerate(xformtree):
+            if not isinstance(item, Struct):
+                comments.append(item)
+                continue
+            ready = [(position, comments + [item])]
+            comments = []
+            while ready:
+                unit_position, unit = ready.pop(0)
+                missing = [name for name in self._held(unit[-1]) if name not in emitted]
+                if missing:
+                    waiting.setdefault(missing[0], []).append((unit_position, unit))
+                    continue
+                yield from unit
+                emitted.add(unit[-1].name)
+                ready.extend(waiting.pop(unit[-1].name, []))
+        #anything still waiting holds a struct that never came
+        for _, unit in sorted(unit for units in waiting.values() for unit in units):
+            yield from unit
+        yield from comments
+
+class SymbolIndex:
+    '''what each input file defines, see source_scanner.find_symbols'''
+    def __init__(self, path=None):
+        '''path is the JSON file the index is kept in, None keeps it in memory'''
+        self.path = path
+        #{absolute path: {"stamp": [mtime, size], "structs": [name, ...], "types": [the
+        #                 types their fields use], "aliases": {name: type}, "constants": {name: value}}}
+        self.files = {}
+        #{type as written: type as IR}, the same few types come up over and over
+        self._parsed = {}
+        #{kind: {name: the first file, in sorted order, that defines it}}
+        self._owners = None
+        if path is not None:
+            self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as indexfile:
+                data = json.load(indexfile)
+        except (OSError, ValueError):
+            return
+        if data.get("version") == INDEX_VERSION:
+            self.files = data["files"]
+
+    def save(self):
+        '''writes the index back, failing quietly since it's only an optimization'''
+        if self.path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            #write to a temp file and rename so concurrent runs never see half an index
+            handle, temppath = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix=".tmp")
+            with os.fdopen(handle, 'w') as indexfile:
+                json.dump({"version": INDEX_VERSION, "files": self.files}, indexfile)
+            os.replace(temppath, self.path)
+        except OSError as err:
+            logging.debug("couldn't write symbol index: %s", err)
+
+    @staticmethod
+    def _scan(path, stamp):
+        '''reads what a file defines'''
+        with open(path) as infile:
+            return SymbolIndex._entry(infile.read(), stamp)
+
+    @staticmethod
+    def _entry(source, stamp):
+        '''what source defines'''
+        #only needed when something changed, so left out of the import
+        from source_scanner import find_symbols
+        entry = {"stamp": stamp, "structs": [], "aliases": {}, "constants": {}}
+        types = set()
+        for kind, name, value in find_symbols(source):
+            if kind == "struct":
+                entry["structs"].append(name)
+                types.update(text for _, text in value)
+            elif kind == "alias":
+                entry["aliases"][name] = value
+            else:
+                entry["constants"][name] = value
+        entry["types"] = sorted(types)
+        return entry
+
+    def update(self, files):
+        '''brings the index up to date with files, rescanning only those whose
+        size or modification time changed and forgetting any that aren't
+        listed. returns the files that were rescanned'''
+        rescanned = []
+        current = {}
+        for path in files:
+            key = os.path.abspath(path)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            entry = self.files.get(key)
+            if entry is None or entry["stamp"] != stamp:
+                entry = self._scan(path, stamp)
+                rescanned.append(path)
+            current[key] = entry
+        self.files = current
+        self._owners = None
+        return rescanned
+
+    def add_source(self, name, source):
+        '''indexes source text that isn't on disk as the file name'''
+        self.files[os.path.abspath(name)] = self._entry(source, None)
+        self._owners = None
+
+    def _lookup(self, kind, name, key):
+        '''the (file, definition) of an alias or constant, preferring the file key's own'''
+        own = self.files.get(key)
+        if own is not None and name in own[kind]:
+            return key, own[kind][name]
+        owner = self._owner(kind, name)
+        return (None, None) if owner is None else (owner, self.files[owner][kind][name])
+
+    def _owner(self, kind, name):
+        '''the first file, in sorted order, that defines name'''
+        if self._owners is None:
+            self._owners = {"structs": {}, "aliases": {}, "constants": {}}
+            for path in sorted(self.files):
+                for owned in self._owners:
+                    for defined in self.files[path][owned]:
+                        self._owners[owned].setdefault(defined, path)
+        return self._owners[kind].get(name)
+
+    def _parse(self, text):
+        if text not in self._parsed:
+            self._parsed[text] = parse_type(text)
+        return self._parsed[text]
+
+    def _types(self, key):
+        '''the types the fields of the structs in the file key use, or of
+        every file's if it's None'''
+        entries = self.files.values() if key is None else [self.files.get(key, {"types": []})]
+        texts = set()
+        for entry in entries:
+            texts.update(entry["types"])
+        return [self._parse(text) for text in sorted(texts)]
+
+    def resolver(self, in_file=None):
+        '''a Resolver for converting in_file, or every input merged together if
+        it's None, holding just the aliases and constants its structs use'''
+        key = None if in_file is None else os.path.abspath(in_file)
+        aliases = {}
+        constants = {}
+        names = [name for ftype in self._types(key) for name in _type_names(ftype)]
+        seen = set()
+        while names:
+            name = names.pop()
+            if name in seen:
+                continue
+            seen.add(name)
+            _, value = self._lookup("constants", name, key)
+            if value is not None:
+                constants[name] = value
+            _, text = self._lookup("aliases", name, key)
+            target = None if text is None else self._parse(text)
+            if target is not None:
+                aliases[name] = target
+                #aliases can be of other aliases
+                names.extend(_type_names(target))
+        if key is None:
+            defined = [name for entry in self.files.values() for name in entry["structs"]]
+        else:
+            defined = self.files.get(key, {"structs": []})["structs"]
+        return Resolver(aliases, constants, defined)
+
+    def imports(self, in_file, plan, out_path):
+        '''the Imports in_file's outputs need for the structs it uses from the
+        other inputs. plan is where each input's outputs go, as
+        batch_converter.output_plan gives it, under out_path'''
+        key = os.path.abspath(in_file)
+        own = self.files.get(key)
+        if own is None:
+            return []
+        resolver = self.resolver(in_file)
+        used = {}
+        for ftype in self._types(key):
+            if ftype is None:
+                continue
+            for name in _type_names(resolver.resolve_type(ftype)):
+                if name in resolver.defined:
+                    continue
+                owner = self._owner("structs", name)
+                if owner is not None:
+                    used.setdefault(owner, set()).add(name)
+        outputs = {os.path.abspath(path): where for path, where in plan.items()}
+        out_dir = outputs[key][0]
+        imports = []
+        for owner in sorted(used):
+            if owner not in outputs:
+                continue
+            other_dir, prefix = outputs[owner]
+            path = os.path.relpath(other_dir, out_dir)
+            package = os.path.relpath(other_dir, out_path)
+            imports.append(Import(prefix, "" if path == "." else path.replace(os.sep, "/"),
+                                  "" if package == "." else package.replace(os.sep, "."),
+                                  sorted(used[owner])))
+        return imports
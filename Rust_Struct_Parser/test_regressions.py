@@ -0,0 +1,395 @@
+'''regression checks for inputs that once broke the converter, run with pytest'''
+import ctypes
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from lark.exceptions import UnexpectedInput
+import benchmark
+from batch_converter import convert_batch
+from ConversionStats import ConversionStats
+from conversion_server import Server
+import file_watcher
+import output_cache
+from TreeBuilder import COMMENT_DEPTH, TreeBuilder
+from TreeToObj import TreeToObj
+from rust_struct_parser import StructConverter, language_filetypes
+from source_scanner import filter_reprc
+from struct_ir import Field, Struct
+from symbol_index import Resolver
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+#compiled once, without touching the on-disk cache
+BUILDER = TreeBuilder(None, TreeToObj())
+
+def _generate(source, languages=("cpp",), **options):
+    converter = StructConverter(None, None, "out", builder=BUILDER, **options)
+    return converter.generate(language_filetypes(languages), source)
+
+def test_unclosed_block_comment_fails_quickly():
+    '''an unclosed /* used to backtrack exponentially in the comment terminals'''
+    source = "#[repr(C)]\npub struct foo {\n    /* " + "ab " * 40 + "\n    pub a: i32,\n}\n"
+    start = time.perf_counter()
+    with pytest.raises(UnexpectedInput):
+        _generate(source)
+    assert time.perf_counter() - start < 5
+
+def test_block_comment_before_comma():
+    '''a block comment between a field's type and its comma is dropped'''
+    source = "// lead\n#[repr(C)] pub struct foo { pub a: i32 /* the a */, pub b: u8, }\n"
+    header = _generate(source)["out.h"]
+    assert "\tint a;\n\tunsigned char b;\n" in header
+
+def _nested_comment(depth):
+    return "/* " * depth + "x" + " */" * depth
+
+@pytest.mark.parametrize("template", ["{}\n#[repr(C)] pub struct foo { pub a: i32, }\n",
+                                      "#[repr(C)] pub struct foo { pub a: i32 {}, pub b: u8, }\n",
+                                      "#[repr(C)] pub struct foo { pub a: {} i32, }\n"])
+def test_block_comments_nest_up_to_the_limit(template):
+    '''comments nest as deep as the grammar's terminals go wherever they can
+    appear, and the error says why when they go deeper'''
+    header = _generate(template.replace("{}", _nested_comment(COMMENT_DEPTH)))["out.h"]
+    assert "\tint a;\n" in header
+    with pytest.raises(UnexpectedInput, match="nested more than {} deep".format(COMMENT_DEPTH)):
+        _generate(template.replace("{}", _nested_comment(COMMENT_DEPTH + 1)))
+
+#a struct that points to itself, one that points ahead and a pair that use each other
+POINTERS = """#[repr(C)] pub struct Node { pub value: i32, pub next: *mut Node, }
+#[repr(C)] pub struct A { pub c: *mut C, pub b: *const B, }
+#[repr(C)] pub struct C { pub a: A, }
+#[repr(C)] pub struct B { pub x: f64, }
+"""
+
+def test_pointers_to_structs_cpp():
+    '''pointers to structs used the typedef, which isn't declared yet inside
+    the struct itself or before a later struct'''
+    header = _generate(POINTERS)["out.h"]
+    assert "\tstruct NodeTag* next;\n" in header
+    assert "\tstruct CTag* c;\n\tstruct BTag* b;\n" in header
+
+def test_pointers_to_structs_python():
+    '''POINTER(T) in a class body raised NameError when T wasn't defined yet'''
+    namespace = {}
+    exec(_generate(POINTERS, ("python",))["out.py"], namespace)
+    assert namespace["Node"].next.offset == 8
+    assert namespace["C"].a.size == 16
+
+def test_pointers_to_structs_split_python(tmp_path, monkeypatch):
+    '''structs that use each other share a module, so they import in any order'''
+    for name, text in _generate(POINTERS, ("python",), split_python=True).items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(text)
+    assert sorted(path.name for path in (tmp_path / "out").iterdir()) == ["_A.py", "_B.py", "_Node.py",
+                                                                        "__init__.py"]
+    monkeypatch.syspath_prepend(str(tmp_path))
+    from out import C, A # pylint: disable=import-error
+    assert A.c.offset == 0 and C.a.size == 16
+
+def test_split_python_imports_structs_lazily(tmp_path, monkeypatch):
+    '''importing the package loads none of the struct modules, using a
+    struct loads its own module and the ones it needs and nothing else'''
+    source = "".join("#[repr(C)] pub struct s{0} {{ pub a: i32, }}\n".format(number) for number in range(50))
+    source += "#[repr(C)] pub struct user { pub one: s1, pub two: *mut s2, }\n"
+    converter = StructConverter(None, None, "lazy", builder=BUILDER, split_python=True)
+    for name, text in converter.generate(language_filetypes(["python"]), source).items():
+        (tmp_path / name).parent.mkdir(parents=True, exist_ok=True)
+        (tmp_path / name).write_text(text)
+    monkeypatch.syspath_prepend(str(tmp_path))
+    def loaded():
+        return sorted(name for name in sys.modules if name.startswith("lazy."))
+    import lazy # pylint: disable=import-error
+    assert loaded() == [] and len(lazy.__all__) == 51
+    assert ctypes.sizeof(lazy.user) == 16
+    assert loaded() == ["lazy._s1", "lazy._s2", "lazy._user"]
+    assert lazy.s1 is sys.modules["lazy._s1"].s1
+
+#builds a parser in a fresh interpreter, with "cached" it fails if the grammar gets compiled
+CACHE_SCRIPT = """import sys
+import lark
+import TreeBuilder
+class NotCompiled(lark.Lark):
+    def __init__(self, *args, **kwargs):
+        raise AssertionError("compiled the grammar")
+if sys.argv[1] == "cached":
+    TreeBuilder.Lark = NotCompiled
+TreeBuilder.TreeBuilder().parse("#[repr(C)] pub struct foo { pub a: i32, }")
+"""
+
+def test_parser_tables_load_from_the_cache(tmp_path):
+    '''the first run compiles the grammar and caches the tables in
+    RUST_STRUCT_PARSER_CACHE, the next one only loads them'''
+    env = dict(os.environ, RUST_STRUCT_PARSER_CACHE=str(tmp_path))
+    def build(mode):
+        return subprocess.run([sys.executable, "-c", CACHE_SCRIPT, mode], cwd=HERE, env=env,
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    assert "compiled the grammar" in build("cached").stdout
+    assert build("compile").returncode == 0
+    assert [path.suffix for path in tmp_path.iterdir()] == [".pickle"]
+    result = build("cached")
+    assert result.returncode == 0, result.stdout
+
+#enough structs to fill several of the chunks the stream parses one at a time
+CHUNKED = "".join("#[repr(C)] pub struct s{} {{ {} }}\n".format(number, " ".join(
+    "pub f{}: [u8; 4],".format(field) for field in range(20))) for number in range(180))
+
+@pytest.mark.parametrize("broken", ["pub struct broken { pub a: i32; }\n",
+                                    "#[repr(C)] pub struct broken { pub a: i32, pub b: u8 % }\n",
+                                    "#[repr(C)] pub struct broken { pub a: i32,\n"])
+def test_stream_errors_point_into_the_whole_input(tmp_path, broken):
+    '''errors in a later chunk give the same position as parsing the whole
+    input, and nothing is written when the input doesn't convert'''
+    #the broken struct starts partway into a line
+    source = CHUNKED + "#[repr(C)] pub struct t { pub a: i32, } " + broken + "pub struct u { pub a: i32, }\n"
+    with pytest.raises(UnexpectedInput) as whole:
+        BUILDER.parse(source)
+    (tmp_path / "in.rs").write_text(source)
+    converter = StructConverter(str(tmp_path / "in.rs"), str(tmp_path / "out"), "out", builder=BUILDER,
+                                split_cpp=True)
+    with pytest.raises(UnexpectedInput) as streamed:
+        converter.stream(language_filetypes(["cpp", "python"]))
+    assert (streamed.value.line, streamed.value.column) == (whole.value.line, whole.value.column)
+    assert streamed.value.pos_in_stream == whole.value.pos_in_stream
+    assert str(streamed.value).split("\n")[0] == str(whole.value).split("\n")[0]
+    assert [str(path) for path in (tmp_path / "out").rglob("*") if path.is_file()] == []
+
+@pytest.mark.parametrize("mode", ["convert", "stream"])
+def test_each_language_is_timed_on_its_own(tmp_path, mode):
+    '''every backend's rendering gets an emit.<language> phase, reported right after emit'''
+    stats = ConversionStats()
+    converter = StructConverter(os.path.join(HERE, "Sample", "full_test.rs"), str(tmp_path), "full",
+                                builder=BUILDER, stats=stats)
+    getattr(converter, mode)(language_filetypes(["csharp", "cpp", "python"]))
+    phases = list(stats.as_dict()["phases"])
+    emit = phases.index("emit")
+    assert phases[emit:emit + 4] == ["emit", "emit.cpp", "emit.csharp", "emit.python"]
+
+def test_resolving_leaves_the_parsed_items_alone():
+    '''the watcher keeps parsed items and resolves them again once an alias
+    changes, which did nothing once the first resolve had replaced the alias'''
+    items = [Struct("b", [Field("h", "Handle")])]
+    assert list(Resolver({"Handle": "u64"}).resolve_items(items))[0].fields[0].type == "u64"
+    assert list(Resolver({"Handle": "u32"}).resolve_items(items))[0].fields[0].type == "u32"
+    assert items[0].fields[0].type == "Handle"
+
+def test_missing_input_is_a_failure(tmp_path):
+    '''a mistyped path found nothing to convert and succeeded'''
+    missing = str(tmp_path / "does_not_exist.rs")
+    assert convert_batch([missing], str(tmp_path / "out"), ["cpp"], workers=1, cache_dir=None) == [
+        (missing, "no such file, or no .rs files in it")]
+
+def test_socket_path_that_isnt_a_socket_is_kept(tmp_path):
+    '''serving on a socket deleted whatever was at its path'''
+    path = tmp_path / "notes.txt"
+    path.write_text("keep me")
+    server = Server(1, None)
+    with pytest.raises(FileExistsError):
+        server.serve_socket(str(path))
+    server.close()
+    assert path.read_text() == "keep me"
+
+def test_output_cache_keeps_a_few_entries_per_input(tmp_path):
+    '''every edit of a watched file added a cache entry that was never removed'''
+    in_file = tmp_path / "a.rs"
+    cache = tmp_path / "cache"
+    for length in range(1, 8):
+        in_file.write_text("#[repr(C)]\npub struct s {{ pub a: [u8; {}], }}\n".format(length))
+        StructConverter(str(in_file), str(tmp_path / "out"), "out", builder=BUILDER,
+                        output_cache_dir=str(cache)).convert(language_filetypes(["cpp"]))
+    groups = list((cache / "outputs").iterdir())
+    assert len(groups) == 1
+    assert len(list(groups[0].iterdir())) == output_cache.ENTRIES_PER_INPUT
+
+def _sample(name):
+    with open(os.path.join(HERE, "Sample", name)) as sample:
+        return sample.read()
+
+#pointers to primitives, to strings and to structs, on their own and in arrays
+POINTER_FIELDS = """#[repr(C)] pub struct p { pub a: *mut i32, pub b: u8, pub c: [*mut c_char; 4],
+    pub d: [*mut p; 2], pub e: *const u8, pub f: [*mut i32; 3], pub g: *mut c_void, }
+"""
+
+@pytest.mark.skipif(shutil.which("g++") is None, reason="needs g++")
+@pytest.mark.parametrize("source", [_sample("full_test.rs"), POINTER_FIELDS], ids=["full_test", "pointers"])
+def test_layout_asserts_compile(tmp_path, source):
+    '''pointers to primitives and arrays of pointers were written as the
+    primitive, so the layout asserts failed on the converter's own output'''
+    header = tmp_path / "out.h"
+    header.write_text(_generate(source, layout_asserts=True)["out.h"])
+    subprocess.run(["g++", "-fsyntax-only", "-x", "c++", str(header)], check=True)
+
+def _python_module(source, **options):
+    '''runs the generated python, returns its namespace and the layouts'''
+    converter = StructConverter(None, None, "out", builder=BUILDER, layout_asserts=True, **options)
+    namespace = {}
+    exec(converter.generate(language_filetypes(["python"]), source)["out.py"], namespace)
+    return namespace, converter.layouts
+
+@pytest.mark.parametrize("source", [_sample("full_test.rs"), POINTER_FIELDS], ids=["full_test", "pointers"])
+def test_ctypes_matches_layout(source):
+    '''the ctypes structs are laid out the way rust lays out the struct'''
+    namespace, layouts = _python_module(source)
+    for name, layout in layouts.items():
+        assert ctypes.sizeof(namespace[name]) == layout.size
+        for field in layout.fields:
+            assert getattr(namespace[name], field.name).offset == field.offset
+
+#arrays, nested structs, arrays of them and pointers, with padding between
+DTYPE_FIELDS = """#[repr(C)] pub struct inner { pub a: u8, pub b: f64, pub c: [i16; 3], }
+#[repr(C)] pub struct outer { pub x: u8, pub nested: inner, pub many: [inner; 2], pub name: *mut c_char,
+    pub values: *const i32, pub names: [*mut c_char; 3], pub next: *mut outer, pub flag: bool, }
+"""
+
+@pytest.mark.parametrize("source", [DTYPE_FIELDS, _sample("full_test.rs"), POINTER_FIELDS],
+                         ids=["nested", "full_test", "pointers"])
+def test_numpy_dtypes_match_ctypes_and_layout(source):
+    '''each dtype has the ctypes struct's size and offsets, which are the rust layout's'''
+    pytest.importorskip("numpy")
+    namespace, layouts = _python_module(source, numpy_dtypes=True)
+    for name, layout in layouts.items():
+        struct, dtype = namespace[name], namespace[name + "_dtype"]
+        assert dtype.itemsize == ctypes.sizeof(struct) == layout.size
+        assert list(dtype.names) == [field.name for field in layout.fields]
+        for field in layout.fields:
+            assert dtype.fields[field.name][1] == getattr(struct, field.name).offset == field.offset
+            assert dtype.fields[field.name][0].itemsize == field.size
+
+def test_numpy_view_reads_ctypes_structs():
+    '''a record array viewed over ctypes structs sees the same values'''
+    pytest.importorskip("numpy")
+    namespace, _ = _python_module(DTYPE_FIELDS, numpy_dtypes=True)
+    records = (namespace["outer"] * 2)()
+    records[1].nested.b = 2.5
+    records[1].many[1].c[2] = -7
+    records[1].flag = True
+    view = namespace["view_buffer"](namespace["outer_dtype"], records)
+    assert view.nested.b[1] == 2.5 and view.many[1][1].c[2] == -7 and view.flag[1]
+
+def _write_struct(path, length):
+    path.write_text("#[repr(C)]\npub struct {} {{ pub x: [u8; {}], }}\n".format(path.stem, length))
+
+def _snapshot(path):
+    return file_watcher._snapshot([str(path)]) # pylint: disable=protected-access
+
+def test_watcher_regenerates_only_what_changed(tmp_path):
+    '''a file is regenerated when it or an alias it uses changes, and not otherwise'''
+    src = tmp_path / "src"
+    src.mkdir()
+    _write_struct(src / "a.rs", 1)
+    (src / "b.rs").write_text("pub type Length = u8;\n#[repr(C)]\npub struct b { pub x: Length, }\n")
+    (src / "c.rs").write_text("#[repr(C)]\npub struct c { pub x: Length, }\n")
+    watcher = file_watcher.Watcher([str(src)], str(tmp_path / "out"), ["cpp"], cache_dir=None)
+    assert len(watcher.update(_snapshot(src))) == 3
+    _write_struct(src / "a.rs", 2)
+    assert watcher.update(_snapshot(src)) == [str(src / "a.rs")]
+    (src / "b.rs").write_text("pub type Length = u16;\n#[repr(C)]\npub struct b { pub x: Length, }\n")
+    assert watcher.update(_snapshot(src)) == [str(src / "b.rs"), str(src / "c.rs")]
+    assert "unsigned short x;" in (tmp_path / "out" / "c.h").read_text()
+
+def _watch_latency(tmp_path):
+    '''runs a watcher in a thread, returns the seconds from each of a few saves
+    to its output having changed'''
+    in_file = tmp_path / "a.rs"
+    _write_struct(in_file, 1)
+    header = tmp_path / "out" / "a.h"
+    watcher = file_watcher.Watcher([str(in_file)], str(tmp_path / "out"), ["cpp"], "a", cache_dir=None)
+    thread = threading.Thread(target=watcher.watch, daemon=True)
+    thread.start()
+    latencies = []
+    try:
+        while not header.exists():
+            time.sleep(0.001)
+        for length in range(2, 7):
+            time.sleep(0.05)
+            start = time.perf_counter()
+            _write_struct(in_file, length)
+            while "[{}]".format(length) not in header.read_text():
+                assert time.perf_counter() - start < 5
+                time.sleep(0.0005)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        watcher.stopping.set()
+        thread.join(5)
+    assert not thread.is_alive()
+    return sorted(latencies)
+
+def test_watch_regenerates_soon_after_a_save(tmp_path):
+    '''with inotify a save is picked up as it happens rather than on the next poll'''
+    try:
+        file_watcher.Inotify().close()
+    except OSError:
+        pytest.skip("needs inotify")
+    latencies = _watch_latency(tmp_path)
+    #well under the 50ms poll interval, leaving room for a busy machine
+    assert latencies[len(latencies) // 2] < 0.04
+
+def test_watch_polls_without_inotify(tmp_path, monkeypatch):
+    '''without inotify the known files are statted every poll interval'''
+    def unavailable():
+        raise OSError("inotify isn't available")
+    monkeypatch.setattr(file_watcher, "Inotify", unavailable)
+    assert _watch_latency(tmp_path)[-1] < 1
+
+#doc comments mixed in with attributes on either side of #[repr(C)]
+ATTRIBUTE_ORDERS = [
+    "/// doc\n#[derive(Debug)]\n#[repr(C)]\npub struct foo { pub a: i32, }\n",
+    "/// doc\n#[repr(C)]\n#[derive(Debug)]\npub struct foo { pub a: i32, }\n",
+    "#[derive(Debug)]\n/// doc\n#[repr(C)]\npub struct foo { pub a: i32, }\n",
+    "#[repr(C)]\n/// doc\n#[derive(Debug)]\npub struct foo { pub a: i32, }\n",
+]
+
+@pytest.mark.parametrize("item", ATTRIBUTE_ORDERS)
+def test_reprc_only_keeps_comments_across_attributes(item):
+    '''comments above a #[derive] that came before #[repr(C)] were dropped'''
+    source = "fn f() {}\n" + item + "pub fn g() {}\n"
+    filtered = filter_reprc(source)
+    assert filtered.count("\n") == source.count("\n")
+    #the struct stays on its line so parse errors point at the original file
+    assert filtered.splitlines()[4].endswith("pub struct foo { pub a: i32, }")
+    assert "derive" not in filtered
+    header = _generate(source, reprc_only=True)["out.h"]
+    assert "/// doc\ntypedef struct fooTag {\n\tint a;\n} foo;\n" in header
+
+def test_reprc_only_drops_comments_above_other_items():
+    '''an attribute doesn't carry comments over to the next item'''
+    source = ("/// a function\n#[inline]\nfn f() {}\n#[repr(C)]\npub struct foo { pub a: i32, }\n"
+              "/// an enum\n#[derive(Debug)]\nenum E { A }\n#[repr(C)]\npub struct bar { pub b: u8, }\n")
+    filtered = filter_reprc(source)
+    assert filtered.count("\n") == source.count("\n")
+    assert "function" not in filtered and "enum" not in filtered
+    assert filtered.count("#[repr(C)]") == 2
+
+def test_benchmark_sources_are_deterministic():
+    '''the same arguments always give the same source, so runs can be compared'''
+    assert benchmark.generate_source(20, 5, seed=3) == benchmark.generate_source(20, 5, seed=3)
+    assert benchmark.generate_source(20, 5, seed=3) != benchmark.generate_source(20, 5, seed=4)
+    mixed = benchmark.generate_mixed_source(10, 5, 3, seed=1)
+    assert mixed == benchmark.generate_mixed_source(10, 5, 3, seed=1)
+    #every generated struct converts, and none of the decoys in the mixed source do
+    source = benchmark.generate_source(20, 5, pointer_ratio=0.3, array_ratio=0.3, comment_ratio=0.3)
+    items = BUILDER.parse(source)
+    assert len([item for item in items if isinstance(item, Struct)]) == 20
+    items = BUILDER.parse(filter_reprc(mixed))
+    assert [item.name for item in items if isinstance(item, Struct)] == ["Struct{}".format(number)
+                                                                         for number in range(10)]
+
+def _benchmark_run(params, parse, peak):
+    return {"scenarios": {"structs": {"params": params, "seconds": {"parse": parse}, "peak_bytes": peak}}}
+
+def test_benchmark_compare_flags_regressions():
+    '''only metrics more than the threshold worse than the baseline are flagged'''
+    params = {"structs": 100, "seed": 0}
+    baseline = _benchmark_run(params, 1.0, 1000)
+    assert benchmark.compare(baseline, _benchmark_run(params, 1.1, 1100)) == []
+    assert benchmark.compare(baseline, _benchmark_run(params, 0.5, 500)) == []
+    assert benchmark.compare(baseline, _benchmark_run(params, 1.2, 1000)) == [
+        ("structs", "seconds.parse", 1.0, 1.2)]
+    assert benchmark.compare(baseline, _benchmark_run(params, 1.0, 2000)) == [
+        ("structs", "peak_bytes", 1000, 2000)]
+    assert benchmark.compare(baseline, _benchmark_run(params, 1.2, 1000), threshold=0.25) == []
+    #a scenario with different parameters, or one the baseline doesn't have, isn't comparable
+    assert benchmark.compare(baseline, _benchmark_run(dict(params, seed=1), 2.0, 2000)) == []
+    assert benchmark.compare({"scenarios": {}}, _benchmark_run(params, 2.0, 2000)) == []